@@ -0,0 +1,80 @@
+"""Redis cache of AI chat replies for near-identical requests.
+
+The key hashes the language, the prompt version (model + system prompt), the
+normalized message and the last few turns of history, so "Make 20 Spanish
+food cards" and "make 20 spanish  food cards!" from a fresh chat share a reply.
+"""
+import os
+import re
+import json
+import time
+import hashlib
+import unicodedata
+
+from chat_history import turn_text
+
+ENABLED = os.getenv("AI_CACHE", "1") == "1"
+TTL = int(os.getenv("AI_CACHE_TTL", 86400))
+MAX_ENTRIES = int(os.getenv("AI_CACHE_MAX_ENTRIES", 10000))
+# bigger replies are not worth keeping
+MAX_BYTES = int(os.getenv("AI_CACHE_MAX_BYTES", 64 * 1024))
+# only the tail of the conversation is part of the key
+HISTORY_TURNS = int(os.getenv("AI_CACHE_HISTORY_TURNS", 4))
+PREFIX = "ai:cache:"
+INDEX = "ai:cache:index"
+
+
+def normalize(text: str) -> str:
+    text = unicodedata.normalize("NFKC", text).casefold()
+    text = re.sub(r"[^\w\s]", "", text)
+    return " ".join(text.split())
+
+
+def cache_key(language: str, prompt_version: str, message: str, history: list) -> str:
+    turns = [[turn.get("role"), normalize(turn_text(turn))] for turn in history[-HISTORY_TURNS:]]
+    material = json.dumps([normalize(language), prompt_version, normalize(message), turns])
+    return PREFIX + hashlib.sha256(material.encode()).hexdigest()
+
+
+class AICache:
+    def __init__(self, redis_client):
+        self.redis = redis_client
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+
+    async def get(self, key: str):
+        try:
+            cached = await self.redis.get(key)
+        except Exception as e:
+            print("Error reading AI cache", e)
+            cached = None
+        if cached is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(cached)
+
+    async def put(self, key: str, reply: dict):
+        data = json.dumps(reply)
+        if len(data) > MAX_BYTES:
+            return
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                pipe.setex(key, TTL, data)
+                pipe.zadd(INDEX, {key: time.time()})
+                # forget index entries that expired on their own
+                pipe.zremrangebyscore(INDEX, 0, time.time() - TTL)
+                pipe.zcard(INDEX)
+                size = (await pipe.execute())[-1]
+            if size > MAX_ENTRIES:
+                oldest = await self.redis.zpopmin(INDEX, size - MAX_ENTRIES)
+                if oldest:
+                    await self.redis.delete(*[k for k, _ in oldest])
+        except Exception as e:
+            print("Error storing AI cache entry", e)
+
+    def metrics(self) -> dict:
+        total = self.hits + self.misses
+        return {"enabled": ENABLED, "hits": self.hits, "misses": self.misses, "bypassed": self.bypassed,
+                "hit_rate": round(self.hits / total, 3) if total else None}
@@ -0,0 +1,118 @@
+"""Redis queue of AI jobs run by ai_worker.py.
+
+ai:jobs:queue               job ids waiting for a worker
+ai:jobs:processing:<worker> ids a worker has claimed (requeued once its heartbeat expires)
+ai:jobs:worker:<worker>     heartbeat of a running worker, expires after HEARTBEAT_TTL
+ai:job:<id>                 hash: kind, status, request, output, error, progress, attempts
+ai:job:<id>:events          pub/sub channel with every status change
+
+Statuses go queued -> running -> done | failed. A job requeued after its worker
+stopped runs again, up to MAX_ATTEMPTS times in all. Jobs are kept JOB_TTL seconds.
+"""
+import os
+import json
+import time
+import secrets
+
+JOB_TTL = int(os.getenv("AI_JOB_TTL", 86400))
+MAX_QUEUE = int(os.getenv("AI_JOBS_MAX_QUEUE", 1000))
+MAX_ATTEMPTS = int(os.getenv("AI_JOB_MAX_ATTEMPTS", 3))
+QUEUE = "ai:jobs:queue"
+PROCESSING = "ai:jobs:processing:"
+WORKER = "ai:jobs:worker:"
+HEARTBEAT_TTL = 60
+PREFIX = "ai:job:"
+KINDS = ("chat", "cards")
+FINISHED = ("done", "failed")
+
+
+class QueueFull(Exception):
+    pass
+
+
+class JobQueue:
+    def __init__(self, redis_client):
+        self.redis = redis_client
+
+    async def enqueue(self, kind: str, request: dict) -> str:
+        if await self.redis.llen(QUEUE) >= MAX_QUEUE:
+            raise QueueFull()
+        job_id = secrets.token_urlsafe(16)
+        now = int(time.time())
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hset(PREFIX + job_id, mapping={"kind": kind, "status": "queued", "request": json.dumps(request),
+                                                "created": now, "updated": now})
+            pipe.expire(PREFIX + job_id, JOB_TTL)
+            pipe.rpush(QUEUE, job_id)
+            await pipe.execute()
+        return job_id
+
+    async def get(self, job_id: str):
+        """Status, progress, output / error of a job, or None."""
+        job = await self.redis.hgetall(PREFIX + job_id)
+        if not job:
+            return None
+        state = {"job_id": job_id, "kind": job["kind"], "status": job["status"],
+                 "progress": int(job.get("progress", 0)), "attempts": int(job.get("attempts", 0)),
+                 "created": int(job["created"]),
+                 "updated": int(job["updated"])}
+        if "output" in job:
+            state["output"] = json.loads(job["output"])
+        if "error" in job:
+            state["error"] = job["error"]
+        return state
+
+    async def request(self, job_id: str):
+        job = await self.redis.hmget(PREFIX + job_id, "kind", "request")
+        if job[0] is None:
+            return None
+        return job[0], json.loads(job[1])
+
+    async def start(self, job_id: str) -> int:
+        """Mark a job running; returns its attempt number, 1 on the first run."""
+        attempts = await self.redis.hincrby(PREFIX + job_id, "attempts", 1)
+        await self.update(job_id, status="running", attempts=attempts)
+        return attempts
+
+    async def update(self, job_id: str, event: dict = None, **fields):
+        """Set job fields and publish the change (plus `event`) to subscribers."""
+        fields["updated"] = int(time.time())
+        stored = {k: json.dumps(v) if k == "output" else v for k, v in fields.items()}
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hset(PREFIX + job_id, mapping=stored)
+            pipe.expire(PREFIX + job_id, JOB_TTL)
+            pipe.publish(events_channel(job_id), json.dumps({**fields, **(event or {})}))
+            await pipe.execute()
+
+    async def claim(self, worker_id: str, timeout: float):
+        """Next job id for a worker, or None after `timeout` seconds."""
+        return await self.redis.blmove(QUEUE, PROCESSING + worker_id, timeout, "LEFT", "RIGHT")
+
+    async def release(self, worker_id: str, job_id: str):
+        await self.redis.lrem(PROCESSING + worker_id, 0, job_id)
+
+    async def requeue_claimed(self, worker_id: str) -> int:
+        """Put back jobs a worker claimed but did not finish."""
+        count = 0
+        while await self.redis.lmove(PROCESSING + worker_id, QUEUE, "RIGHT", "LEFT"):
+            count += 1
+        return count
+
+    async def heartbeat(self, worker_id: str):
+        await self.redis.set(WORKER + worker_id, int(time.time()), ex=HEARTBEAT_TTL)
+
+    async def stop(self, worker_id: str):
+        await self.redis.delete(WORKER + worker_id)
+
+    async def requeue_stale(self) -> int:
+        """Requeue the jobs of workers whose heartbeat expired."""
+        count = 0
+        async for key in self.redis.scan_iter(match=PROCESSING + "*"):
+            worker_id = key[len(PROCESSING):]
+            if not await self.redis.exists(WORKER + worker_id):
+                count += await self.requeue_claimed(worker_id)
+        return count
+
+
+def events_channel(job_id: str) -> str:
+    return PREFIX + job_id + ":events"
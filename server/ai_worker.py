@@ -0,0 +1,114 @@
+"""Runs queued AI jobs (see ai_jobs.py) outside the API processes:
+
+    python ai_worker.py
+
+Each process runs AI_WORKER_CONCURRENCY jobs at a time and keeps a heartbeat
+in Redis. Jobs claimed by a worker whose heartbeat expired are requeued by the
+others. AI_WORKER_ID defaults to <host>-<pid>; a fixed id must be unique per
+process, and a worker restarted with it requeues its previous run's jobs at once.
+"""
+import os
+import socket
+import asyncio
+
+import redis.asyncio as redis
+from dotenv import load_dotenv
+
+load_dotenv()
+
+import gemini
+import ai_jobs
+import chat_history
+import deck_generation
+
+WORKER_ID = os.getenv("AI_WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}"
+CONCURRENCY = int(os.getenv("AI_WORKER_CONCURRENCY", 4))
+AI_TIMEOUT = float(os.getenv("AI_TIMEOUT", 60))
+CLAIM_TIMEOUT = 5
+HEARTBEAT_INTERVAL = ai_jobs.HEARTBEAT_TTL / 4
+
+
+async def run_chat(queue: ai_jobs.JobQueue, request: dict) -> dict:
+    history = request.get("history") or []
+    summary, history = await chat_history.bound_or_truncate(history, queue.redis, gemini.summarize)
+    return await gemini.chat_async(request["message"], request["language"], history, summary)
+
+
+async def run_cards(queue: ai_jobs.JobQueue, job_id: str, request: dict) -> dict:
+    cards = []
+    failed = 0
+    async for chunk in deck_generation.generate_deck(request["topic"], request["count"], request["language"],
+                                                     request.get("level"), request.get("subtopics"),
+                                                     chunk_timeout=AI_TIMEOUT):
+        if chunk["cards"] is None:
+            failed += 1
+            continue
+        cards += chunk["cards"]
+        await queue.update(job_id, event={"cards": chunk["cards"]}, progress=len(cards))
+    return {"cards": cards, "count": len(cards), "failed_chunks": failed}
+
+
+async def run_job(queue: ai_jobs.JobQueue, job_id: str):
+    job = await queue.request(job_id)
+    if job is None:
+        # expired before a worker got to it
+        return
+    kind, request = job
+    if await queue.start(job_id) > ai_jobs.MAX_ATTEMPTS:
+        # every earlier run stopped its worker before finishing
+        print("AI job", job_id, kind, "failed after", ai_jobs.MAX_ATTEMPTS, "attempts")
+        await queue.update(job_id, status="failed", error="TooManyAttempts")
+        return
+    try:
+        if kind == "chat":
+            # the history summary counts against the timeout too
+            output = await asyncio.wait_for(run_chat(queue, request), AI_TIMEOUT)
+        else:
+            output = await run_cards(queue, job_id, request)
+    except Exception as e:
+        print("Error in AI job", job_id, kind, type(e).__name__, e)
+        await queue.update(job_id, status="failed", error=type(e).__name__)
+        return
+    await queue.update(job_id, status="done", output=output)
+
+
+async def work(queue: ai_jobs.JobQueue):
+    while True:
+        job_id = await queue.claim(WORKER_ID, CLAIM_TIMEOUT)
+        if job_id is None:
+            continue
+        try:
+            await run_job(queue, job_id)
+        except Exception as e:
+            print("Error running AI job", job_id, e)
+        # not released when cancelled: the job stays claimed and is requeued
+        await queue.release(WORKER_ID, job_id)
+
+
+async def keep_alive(queue: ai_jobs.JobQueue):
+    while True:
+        await asyncio.sleep(HEARTBEAT_INTERVAL)
+        await queue.heartbeat(WORKER_ID)
+        requeued = await queue.requeue_stale()
+        if requeued:
+            print("AI worker", WORKER_ID, "requeued", requeued, "jobs of stopped workers")
+
+
+async def main():
+    client = redis.Redis(host=os.getenv("REDIS_HOST"), port=int(os.getenv("REDIS_PORT", 6379)), db=0,
+                         decode_responses=True)
+    queue = ai_jobs.JobQueue(client)
+    # announce this worker before claiming, so no other worker takes its jobs for a stopped one's
+    await queue.heartbeat(WORKER_ID)
+    requeued = await queue.requeue_claimed(WORKER_ID) + await queue.requeue_stale()
+    print("AI worker", WORKER_ID, "started,", requeued, "jobs requeued")
+    try:
+        await asyncio.gather(keep_alive(queue), *(work(queue) for _ in range(CONCURRENCY)))
+    finally:
+        await queue.requeue_claimed(WORKER_ID)
+        await queue.stop(WORKER_ID)
+        await client.aclose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
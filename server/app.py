@@ -1,18 +1,38 @@
 import os
-import re
 import json
-from datetime import timedelta
+import math
+import asyncio
+import socket
+from contextlib import asynccontextmanager
+from typing import Literal, Optional
 
+import db
+import media
+from etags import etag_matches, etag_headers, not_modified
+from response_cache import cached
+from limits import ConcurrencyLimiter, LimitExceeded
+from db import COLLECTION_COLUMNS, encode_json, prefixed_columns
+import changes
 import gemini
-import psycopg2
-from psycopg2.extras import RealDictCursor
-import redis
+import ai_cache
+import ai_jobs
+import chat_history
+import chat_sessions
+import deck_generation
+import response_cache
+import token_cache
+import token_verifier
+import search_index
+import snapshots
+from search_index import sanitize_query
+import redis.asyncio as redis
 import firebase_admin
 from firebase_admin import auth
 from dotenv import load_dotenv
-from fastapi import FastAPI, Depends, HTTPException, Request, status
-from fastapi.responses import JSONResponse, FileResponse
-from pydantic import BaseModel
+from fastapi import FastAPI, Depends, HTTPException, Query, Request, status
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, FileResponse, Response, StreamingResponse
+from pydantic import BaseModel, Field
 
 # Load environment
 load_dotenv()
@@ -21,14 +41,93 @@ load_dotenv()
 DB_NAME = "serverdata.db"
 CARDS_COLLECTION_PREVIEW = 10
 MEDIA_FOLDER = "media/"
-CACHE_TTL = 900
 FAKE_API = False
 DEFAULT_LANGUAGE = "English"
+# Gemini models built at startup, others on first use
+AI_LANGUAGES = os.getenv("AI_LANGUAGES", DEFAULT_LANGUAGE).split(",")
+# Gemini calls in flight: overall, per signed-in user, and how long a request may wait
+# for a slot (AI_MAX_QUEUE requests at most) or take to generate
+AI_MAX_CONCURRENCY = int(os.getenv("AI_MAX_CONCURRENCY", 8))
+AI_MAX_PER_USER = int(os.getenv("AI_MAX_PER_USER", 2))
+AI_QUEUE_TIMEOUT = float(os.getenv("AI_QUEUE_TIMEOUT", 10))
+AI_MAX_QUEUE = int(os.getenv("AI_MAX_QUEUE", 32))
+AI_TIMEOUT = float(os.getenv("AI_TIMEOUT", 60))
+JOB_EVENTS_KEEPALIVE = 15
 SECRET_KEY = os.getenv("SECRET_KEY")
 MODEL = os.getenv("MODEL", "gemini")
+SEARCH_LIMIT = 20
+SEARCH_MAX_LIMIT = 100
+# ts_rank weights for {D, C, B, A}: description (C) < tags (B) < name (A)
+SEARCH_WEIGHTS = "{0.1, 0.2, 0.4, 1.0}"
+# "memory": in-process BM25 index (search_index.py), "postgres": full-text search query
+SEARCH_ENGINE = os.getenv("SEARCH_ENGINE", "memory")
+DOWNLOAD_CHUNK_ROWS = 500
+SNAPSHOT_LOCK_TTL = 600
+SNAPSHOT_HOST = socket.gethostname()
+MEDIA_BATCH_MAX = 1000
+LIBRARY_PER_GROUP = 10
+LIBRARY_MAX_PER_GROUP = 50
+# the client shows collections without a group under "Other"
+OTHER_GROUP_ID = 0
+
+# group memberships, with collections in no group put in the "Other" group
+LIBRARY_MEMBERSHIPS = f"""memberships AS (
+    SELECT group_id, collection_id FROM collection_groups
+    UNION
+    SELECT {OTHER_GROUP_ID}, c.id FROM collections c
+    WHERE NOT EXISTS (SELECT 1 FROM collection_groups cg WHERE cg.collection_id = c.id)
+)"""
+
+LIBRARY_FLAT_QUERY = f"""
+    SELECT json_build_object(
+        'collections', (SELECT coalesce(json_agg(c ORDER BY c.id), '[]')
+                        FROM (SELECT {COLLECTION_COLUMNS} FROM collections) c),
+        'groups', (SELECT coalesce(json_agg(g ORDER BY g.id), '[]') FROM groups g),
+        'collection_groups', (SELECT coalesce(json_agg(cg), '[]') FROM collection_groups cg)
+    )
+"""
+
+LIBRARY_GROUPED_QUERY = f"""
+    WITH {LIBRARY_MEMBERSHIPS},
+    grouped AS (
+        SELECT m.group_id, json_agg(c ORDER BY c.id) AS collections
+        FROM memberships m
+        JOIN LATERAL (SELECT {COLLECTION_COLUMNS} FROM collections WHERE id = m.collection_id) c ON true
+        GROUP BY m.group_id
+    )
+    SELECT json_build_object('groups', coalesce(json_agg(
+        json_build_object('id', g.id, 'name', g.name, 'description', g.description,
+                          'collections', gr.collections)
+        ORDER BY g.id = {OTHER_GROUP_ID}, g.id), '[]'))
+    FROM groups g JOIN grouped gr ON gr.group_id = g.id
+"""
+
+# see migrations/004_cards_collection_index.sql
+CARDS_PAGE_QUERY = "SELECT * FROM cards WHERE collectionId = %s AND id > %s ORDER BY id LIMIT %s"
+
+COLLECTION_MEDIA_QUERY = """
+    SELECT 'sounds' AS kind, id, file FROM sounds
+    WHERE id IN (SELECT frontSound FROM cards WHERE collectionId = %(collection_id)s
+                 UNION SELECT backSound FROM cards WHERE collectionId = %(collection_id)s)
+      AND NOT id = ANY(%(skip_sounds)s)
+    UNION ALL
+    SELECT 'images' AS kind, id, file FROM images
+    WHERE id IN (SELECT frontImg FROM cards WHERE collectionId = %(collection_id)s
+                 UNION SELECT backImg FROM cards WHERE collectionId = %(collection_id)s)
+      AND NOT id = ANY(%(skip_images)s)
+    ORDER BY kind, id
+"""
+
+MEDIA_BATCH_QUERY = """
+    SELECT 'sounds' AS kind, id, file FROM sounds WHERE id = ANY(%s)
+    UNION ALL
+    SELECT 'images' AS kind, id, file FROM images WHERE id = ANY(%s)
+    ORDER BY kind, id
+"""
 
 # Initialize Firebase
 firebase_app = firebase_admin.initialize_app()
+verify_id_token = token_verifier.verify_function(firebase_app)
 
 # Initialize Redis
 redis_client = redis.Redis(
@@ -38,48 +137,161 @@ redis_client = redis.Redis(
     decode_responses=True
 )
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await db.open_async_pool()
+    gemini.warm_up(AI_LANGUAGES)
+    if SEARCH_ENGINE == "memory":
+        async with db.async_connection() as con:
+            await search_index.load(con, COLLECTION_COLUMNS)
+    await sound_paths.refresh()
+    await image_paths.refresh()
+    print("media paths loaded:", len(sound_paths), "sounds,", len(image_paths), "images")
+    listener = asyncio.create_task(changes.listen(redis_client))
+    yield
+    listener.cancel()
+    await db.close_async_pool()
+    await redis_client.aclose()
+    await response_cache.client.aclose()
+
+
+app = FastAPI(lifespan=lifespan)
+# id -> file lookups for the media download routes
+sound_paths = media.MediaPathCache(MEDIA_FOLDER, "sounds")
+image_paths = media.MediaPathCache(MEDIA_FOLDER, "images")
+background_tasks = set()
 
 ### Utility functions ###
 
-def get_db_connection():
-    return psycopg2.connect(
-        host=os.getenv("DB_HOST"),
-        port=os.getenv("DB_PORT"),
-        dbname=os.getenv("DB_NAME"),
-        user=os.getenv("DB_USER"),
-        password=os.getenv("DB_PASSWORD")
+async def find_ranked(con, query: str, limit: int = SEARCH_LIMIT) -> list:
+    """Full-text search over collections (see migrations/001_collections_search.sql),
+    ranked name > tags > description, with a trigram fallback for typos."""
+    words = query.lower().split()
+    if not words:
+        return []
+    ts_query = " | ".join(f"{word}:*" for word in words)
+    cursor = await con.execute(
+        f"""SELECT {COLLECTION_COLUMNS}
+            FROM collections, to_tsquery('simple', %s) AS q
+            WHERE search_vector @@ q
+            ORDER BY ts_rank(%s, search_vector, q) DESC, id
+            LIMIT %s""",
+        (ts_query, SEARCH_WEIGHTS, limit)
+    )
+    results = await cursor.fetchall()
+    if results:
+        return results
+    text = " ".join(words)
+    cursor = await con.execute(
+        f"""SELECT {COLLECTION_COLUMNS}
+            FROM collections
+            WHERE %s <%% search_text
+            ORDER BY word_similarity(%s, search_text) DESC, id
+            LIMIT %s""",
+        (text, text, limit)
     )
+    return await cursor.fetchall()
 
 
-def sanitize_query(query: str) -> str:
-    return re.sub(r'[^\w\s\d]', '', query)
+@changes.on_change
+async def refresh_search_index(collection_ids: list):
+    if SEARCH_ENGINE != "memory":
+        return
+    async with db.async_connection() as con:
+        await search_index.refresh(con, COLLECTION_COLUMNS, collection_ids)
 
 
-def find_fuzzy(con, query: str) -> list:
-    cursor = con.cursor(cursor_factory=RealDictCursor)
-    words = query.split()
-    like_clauses = " OR ".join([
-        "name ILIKE %s OR description ILIKE %s OR tags ILIKE %s"
-        for _ in words
-    ])
-    search_query = f"SELECT * FROM collections WHERE {like_clauses}"
-    params = [f"%{word}%" for word in words for _ in range(3)]
-    cursor.execute(search_query, params)
-    return [dict(row) for row in cursor.fetchall()]
+@changes.on_change
+async def evict_cached_responses(collection_ids: list):
+    await response_cache.evict(response_cache.collection_tags(collection_ids))
+
+
+@changes.on_change
+async def refresh_media_paths(collection_ids: list):
+    # imports may add sounds and images along with the cards
+    await sound_paths.refresh()
+    await image_paths.refresh()
+
+
+async def rebuild_snapshots(collection_ids: list):
+    # SNAPSHOT_FOLDER is local to each host, so the keys are per host: among
+    # the workers of one host only one rebuilds. A change arriving during a
+    # rebuild leaves the pending mark set, and the lock holder builds again,
+    # so the last change is never skipped.
+    name = f"{SNAPSHOT_HOST}:" + (",".join(map(str, sorted(collection_ids))) or "all")
+    pending, lock = "snapshot_pending:" + name, "snapshot_lock:" + name
+    await redis_client.set(pending, 1, ex=SNAPSHOT_LOCK_TTL)
+    while await redis_client.set(lock, 1, nx=True, ex=SNAPSHOT_LOCK_TTL):
+        try:
+            while await redis_client.getdel(pending):
+                await snapshots.build_many(collection_ids)
+        except Exception as e:
+            print("Error in rebuild_snapshots", collection_ids, e)
+        finally:
+            await redis_client.delete(lock)
+        # marked between the last check and the release of the lock
+        if not await redis_client.exists(pending):
+            break
+
+
+@changes.on_change
+async def schedule_snapshot_rebuild(collection_ids: list):
+    run_in_background(rebuild_snapshots(collection_ids))
+
+
+def run_in_background(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
 
 
 ### Firebase auth dependency ###
 
-def verify_token_with_cache(id_token: str) -> dict:
-    cached = redis_client.get(f"firebase_token:{id_token}")
-    if cached:
-        return json.loads(cached)
-    decoded = auth.verify_id_token(id_token)
-    redis_client.setex(f"firebase_token:{id_token}", timedelta(seconds=CACHE_TTL), json.dumps(decoded))
+local_tokens = token_cache.TokenCache()
+
+async def verify_token_with_cache(id_token: str) -> dict:
+    """Verified claims of a Firebase ID token: in-process LRU, then Redis,
+    then firebase_admin. Raises auth.InvalidIdTokenError for bad tokens."""
+    key = token_cache.token_key(id_token)
+    entry = local_tokens.get(key)
+    if entry is None:
+        entry = await load_cached_token(key)
+    if entry is not None:
+        claims, error = entry
+        if error:
+            raise auth.InvalidIdTokenError(error)
+        return claims
+    local_tokens.verified += 1
+    try:
+        # keep the occasional certificate fetch and the signature check off the event loop
+        decoded = await run_in_threadpool(verify_id_token, id_token)
+    except auth.InvalidIdTokenError as e:
+        # only bad tokens are cached, not certificate fetch or network errors
+        local_tokens.put(key, error=str(e))
+        await redis_client.setex(f"firebase_token:{key}", token_cache.NEGATIVE_TTL, json.dumps({"error": str(e)}))
+        raise
+    ttl = token_cache.claims_ttl(decoded)
+    if ttl >= 1:
+        local_tokens.put(key, claims=decoded, ttl=ttl)
+        await redis_client.setex(f"firebase_token:{key}", int(ttl), json.dumps(decoded))
     return decoded
 
 
+async def load_cached_token(key: str):
+    """(claims, error) from Redis, copied into the local cache."""
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.get(f"firebase_token:{key}")
+    pipe.ttl(f"firebase_token:{key}")
+    cached, ttl = await pipe.execute()
+    if not cached:
+        return None
+    value = json.loads(cached)
+    entry = (None, value["error"]) if "error" in value else (value, None)
+    local_tokens.put(key, *entry, ttl=ttl)
+    return entry
+
+
 async def get_current_user(request: Request) -> dict:
     auth_header = request.headers.get("Authorization", "")
     if not auth_header.startswith("Bearer "):
@@ -87,7 +299,7 @@ async def get_current_user(request: Request) -> dict:
                             detail="Missing or invalid token")
     token = auth_header.split()[1]
     try:
-        return verify_token_with_cache(token)
+        return await verify_token_with_cache(token)
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
                             detail=str(e))
@@ -105,143 +317,707 @@ async def verify(user: dict = Depends(get_current_user)):
 
 
 @app.get("/collections/search")
-def search_collections(query: str):
+@cached("search")
+async def search_collections(request: Request, query: str, limit: int = Query(SEARCH_LIMIT, ge=1, le=SEARCH_MAX_LIMIT)):
     try:
         q = sanitize_query(query)
-        con = get_db_connection()
-        results = find_fuzzy(con, q)
+        if SEARCH_ENGINE == "memory" and search_index.ready:
+            return {"results": search_index.search(q, limit)}
+        async with db.async_connection() as con:
+            results = await find_ranked(con, q, limit)
     except Exception:
         raise HTTPException(status_code=500, detail="Error searching collections")
-    finally:
-        con.close()
     return {"results": results}
 
 
 @app.get("/collections/preview/{collection_id}")
-def get_collection_preview(collection_id: int):
-    try:
-        con = get_db_connection()
-        cursor = con.cursor(cursor_factory=RealDictCursor)
-        cursor.execute("SELECT * FROM collections WHERE id = %s", (collection_id,))
-        coll = cursor.fetchone()
-        if not coll:
-            return {"collection": None}
-        collection = dict(coll)
-        cursor.execute(
-            "SELECT * FROM cards WHERE collectionId = %s LIMIT %s",
-            (collection_id, CARDS_COLLECTION_PREVIEW)
-        )
-        cards = [dict(row) for row in cursor.fetchall()]
+@cached("collection:{collection_id}")
+async def get_collection_preview(request: Request, response: Response, collection_id: int):
+    try:
+        async with db.async_connection() as con:
+            cursor = await con.execute(f"SELECT {COLLECTION_COLUMNS}, version FROM collections WHERE id = %s", (collection_id,))
+            collection = await cursor.fetchone()
+            if not collection:
+                return {"collection": None}
+            etag = f'"p{collection_id}-v{collection.pop("version")}"'
+            if etag_matches(request, etag):
+                return not_modified(etag)
+            cursor = await con.execute(
+                "SELECT * FROM cards WHERE collectionId = %s LIMIT %s",
+                (collection_id, CARDS_COLLECTION_PREVIEW)
+            )
+            cards = await cursor.fetchall()
     except Exception:
         raise HTTPException(status_code=500, detail="Error fetching preview")
-    finally:
-        con.close()
+    response.headers.update(etag_headers(etag))
     return {"collection": collection, "cards": cards}
 
 
 @app.get("/collections/download/{collection_id}")
-def get_collection_download(collection_id: int):
-    try:
-        con = get_db_connection()
-        cursor = con.cursor(cursor_factory=RealDictCursor)
-        cursor.execute("SELECT * FROM collections WHERE id = %s", (collection_id,))
-        coll = cursor.fetchone()
-        if not coll:
-            return {"collection": None}
-        collection = dict(coll)
-        cursor.execute("SELECT * FROM cards WHERE collectionId = %s", (collection_id,))
-        cards = [dict(row) for row in cursor.fetchall()]
+async def get_collection_download(request: Request, collection_id: int, format: str = Query("json", pattern="^(json|ndjson)$")):
+    # snapshots and cached bodies are keyed by collections.version, so a write
+    # is never served stale, whether or not its change signal arrives
+    try:
+        async with db.async_connection() as con:
+            cursor = await con.execute("SELECT version FROM collections WHERE id = %s", (collection_id,))
+            row = await cursor.fetchone()
     except Exception:
         raise HTTPException(status_code=500, detail="Error fetching download")
-    finally:
-        con.close()
-    return {"collection": collection, "cards": cards}
+    if not row:
+        return {"collection": None}
+    version = row["version"]
+    if format == "json":
+        snapshot = snapshots.snapshot_path(collection_id, version, request.headers.get("Accept-Encoding", ""))
+        if snapshot:
+            path, encoding = snapshot
+            etag = f'"c{collection_id}-v{version}-json-{encoding}"'
+            if etag_matches(request, etag):
+                return not_modified(etag)
+            return FileResponse(path, media_type="application/json",
+                                headers={"Content-Encoding": encoding, "Vary": "Accept-Encoding", **etag_headers(etag)})
+        if not snapshots.has_snapshot(collection_id, version):
+            run_in_background(rebuild_snapshots([collection_id]))
+    return await download_from_database(request=request, collection_id=collection_id, format=format, version=version)
 
 
-@app.get("/collections/library")
-def get_collection_library():
-    try:
-        con = get_db_connection()
-        cursor = con.cursor(cursor_factory=RealDictCursor)
-        cursor.execute("SELECT * FROM collections")
-        collections = [dict(r) for r in cursor.fetchall()]
-        cursor.execute("SELECT * FROM groups")
-        groups = [dict(r) for r in cursor.fetchall()]
-        cursor.execute("SELECT * FROM collection_groups")
-        cgroups = [dict(r) for r in cursor.fetchall()]
+# cached after the snapshot check: the key does not include Accept-Encoding,
+# so a cached body must never stand in for a compressed snapshot
+@cached("collection:{collection_id}", vary="v{version}")
+async def download_from_database(request: Request, collection_id: int, format: str, version: int):
+    try:
+        async with db.async_connection() as con:
+            cursor = await con.execute(f"SELECT {COLLECTION_COLUMNS}, version FROM collections WHERE id = %s", (collection_id,))
+            collection = await cursor.fetchone()
     except Exception:
+        raise HTTPException(status_code=500, detail="Error fetching download")
+    if not collection:
+        return {"collection": None}
+    etag = f'"c{collection_id}-v{collection.pop("version")}-{format}"'
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    if format == "ndjson":
+        return StreamingResponse(stream_cards_ndjson(collection), media_type="application/x-ndjson",
+                                 headers=etag_headers(etag))
+    return StreamingResponse(stream_cards_json(collection), media_type="application/json",
+                             headers=etag_headers(etag))
+
+
+async def stream_cards(collection_id: int):
+    """Yield lists of encoded cards in keyset pages of DOWNLOAD_CHUNK_ROWS.
+    The connection goes back to the pool between pages, so slow clients
+    reading the body do not hold one."""
+    last_id = 0
+    while True:
+        async with db.async_connection() as con:
+            cursor = await con.execute(CARDS_PAGE_QUERY, (collection_id, last_id, DOWNLOAD_CHUNK_ROWS))
+            rows = await cursor.fetchall()
+        if rows:
+            yield [encode_json(row) for row in rows]
+        if len(rows) < DOWNLOAD_CHUNK_ROWS:
+            return
+        last_id = rows[-1]["id"]
+
+
+async def stream_cards_json(collection: dict):
+    # same document as the non-streaming response: {"collection": ..., "cards": [...]}
+    yield b'{"collection":' + encode_json(collection) + b',"cards":['
+    first = True
+    try:
+        async for cards in stream_cards(collection["id"]):
+            yield (b"" if first else b",") + b",".join(cards)
+            first = False
+    except Exception as e:
+        print("Error in stream_cards_json", e)
+        # abort the response rather than end a truncated document normally
+        raise
+    yield b"]}"
+
+
+async def stream_cards_ndjson(collection: dict):
+    # first line is {"collection": ...}, then one card per line
+    yield encode_json({"collection": collection}) + b"\n"
+    try:
+        async for cards in stream_cards(collection["id"]):
+            yield b"\n".join(cards) + b"\n"
+    except Exception as e:
+        print("Error in stream_cards_ndjson", e)
+        raise
+
+
+@app.get("/collections/library")
+@cached("library")
+async def get_collection_library(request: Request, layout: Literal["flat", "grouped"] = "flat"):
+    """The whole library as one JSON document assembled by Postgres.
+
+    flat: {"collections", "groups", "collection_groups"} as stored.
+    grouped: {"groups": [{..., "collections": [...]}]}, collections without a
+    group under the "Other" group, which comes last.
+    """
+    try:
+        async with db.async_connection() as con:
+            etag = await library_etag(con, "" if layout == "flat" else "-grouped")
+            if etag_matches(request, etag):
+                return not_modified(etag)
+            query = LIBRARY_FLAT_QUERY if layout == "flat" else LIBRARY_GROUPED_QUERY
+            content = await db.fetch_json(con, query)
+    except Exception as e:
+        print("Error in get_collection_library", e)
         raise HTTPException(status_code=500, detail="Error fetching library")
-    finally:
-        con.close()
-    return {"collections": collections, "groups": groups, "collection_groups": cgroups}
+    return Response(content, media_type="application/json", headers=etag_headers(etag))
 
 
-@app.get("/sounds/download/{sound_id}")
-def get_sound_download(sound_id: int):
-    try:
-        print("/sounds/download/", sound_id)
-        con = get_db_connection()
-        cursor = con.cursor()
-        cursor.execute("SELECT file FROM sounds WHERE id = %s", (sound_id,))
-        res = cursor.fetchone()
-        if not res:
-            raise HTTPException(status_code=404, detail="Data not found")
-        path = os.path.join(MEDIA_FOLDER, res[0])
-        if not os.path.exists(path):
-            raise HTTPException(status_code=404, detail="File not found")
-        return FileResponse(path, filename=res[0], media_type='application/octet-stream')
+async def library_etag(con, variant: str = "") -> str:
+    cursor = await con.execute("SELECT generation FROM library_state")
+    return f'"lib-{(await cursor.fetchone())["generation"]}{variant}"'
+
+
+@app.get("/collections/library/groups")
+@cached("library")
+async def get_library_groups(request: Request, response: Response):
+    """Groups with their collection counts, without the collections."""
+    try:
+        async with db.async_connection() as con:
+            etag = await library_etag(con, "-groups")
+            if etag_matches(request, etag):
+                return not_modified(etag)
+            cursor = await con.execute(f"""
+                WITH {LIBRARY_MEMBERSHIPS}
+                SELECT g.id, g.name, g.description, count(m.collection_id) AS collections_count
+                FROM groups g JOIN memberships m ON m.group_id = g.id
+                GROUP BY g.id
+                ORDER BY g.id = %s, g.id""", (OTHER_GROUP_ID,))
+            groups = await cursor.fetchall()
     except Exception as e:
-        print("Error in get_sound_download", e)
-        raise HTTPException(status_code=500, detail="Error fetching sound")
-    finally:
-        con.close()
+        print("Error in get_library_groups", e)
+        raise HTTPException(status_code=500, detail="Error fetching library groups")
+    response.headers.update(etag_headers(etag))
+    return {"groups": groups}
+
+
+@app.get("/collections/library/top")
+@cached("library")
+async def get_library_top(request: Request, response: Response,
+                          per_group: int = Query(LIBRARY_PER_GROUP, ge=1, le=LIBRARY_MAX_PER_GROUP)):
+    """Every non-empty group with its first `per_group` collections; fetch the
+    rest with /collections/library/groups/{id}?cursor=<next_cursor>."""
+    try:
+        async with db.async_connection() as con:
+            etag = await library_etag(con, f"-top{per_group}")
+            if etag_matches(request, etag):
+                return not_modified(etag)
+            cursor = await con.execute(f"""
+                WITH {LIBRARY_MEMBERSHIPS},
+                ranked AS (
+                    SELECT group_id, collection_id,
+                           row_number() OVER (PARTITION BY group_id ORDER BY collection_id) AS rank,
+                           count(*) OVER (PARTITION BY group_id) AS total
+                    FROM memberships
+                )
+                SELECT r.group_id, r.total, {prefixed_columns("c")}
+                FROM ranked r JOIN collections c ON c.id = r.collection_id
+                WHERE r.rank <= %s
+                ORDER BY r.group_id, r.rank""", (per_group,))
+            rows = await cursor.fetchall()
+            cursor = await con.execute("SELECT * FROM groups ORDER BY id = %s, id", (OTHER_GROUP_ID,))
+            groups = await cursor.fetchall()
+    except Exception as e:
+        print("Error in get_library_top", e)
+        raise HTTPException(status_code=500, detail="Error fetching library")
+    by_group = {}
+    for row in rows:
+        group_id, total = row.pop("group_id"), row.pop("total")
+        entry = by_group.setdefault(group_id, {"total": total, "collections": []})
+        entry["collections"].append(row)
+    result = []
+    for group in groups:
+        entry = by_group.get(group["id"])
+        if not entry:
+            continue
+        collections = entry["collections"]
+        more = entry["total"] > len(collections)
+        result.append({**group, "total": entry["total"], "collections": collections,
+                       "next_cursor": collections[-1]["id"] if more else None})
+    response.headers.update(etag_headers(etag))
+    return {"groups": result}
+
+
+@app.get("/collections/library/groups/{group_id}")
+@cached("library")
+async def get_library_group_page(request: Request, response: Response, group_id: int,
+                                 cursor: Optional[int] = None,
+                                 limit: int = Query(LIBRARY_PER_GROUP, ge=1, le=LIBRARY_MAX_PER_GROUP)):
+    """Next page of a group's collections, after the collection id `cursor`."""
+    try:
+        async with db.async_connection() as con:
+            etag = await library_etag(con, f"-g{group_id}-{cursor}-{limit}")
+            if etag_matches(request, etag):
+                return not_modified(etag)
+            rows = await con.execute(f"""
+                WITH {LIBRARY_MEMBERSHIPS}
+                SELECT {prefixed_columns("c")}
+                FROM memberships m JOIN collections c ON c.id = m.collection_id
+                WHERE m.group_id = %s AND m.collection_id > %s
+                ORDER BY m.collection_id
+                LIMIT %s""", (group_id, -1 if cursor is None else cursor, limit + 1))
+            collections = await rows.fetchall()
+    except Exception as e:
+        print("Error in get_library_group_page", e)
+        raise HTTPException(status_code=500, detail="Error fetching library")
+    more = len(collections) > limit
+    collections = collections[:limit]
+    response.headers.update(etag_headers(etag))
+    return {"collections": collections, "next_cursor": collections[-1]["id"] if more else None}
+
+
+@app.get("/collections/{collection_id}/media")
+async def get_collection_media(collection_id: int,
+                               skip_sounds: list[int] = Query([]),
+                               skip_images: list[int] = Query([])):
+    """Zip of every sound and image used by the collection's cards, minus the
+    ids the client already has. manifest.json maps ids to archive paths; files
+    missing on disk are left out of both."""
+    try:
+        async with db.async_connection() as con:
+            cursor = await con.execute("SELECT 1 FROM collections WHERE id = %s", (collection_id,))
+            if not await cursor.fetchone():
+                raise HTTPException(status_code=404, detail="Collection not found")
+            cursor = await con.execute(COLLECTION_MEDIA_QUERY, {
+                "collection_id": collection_id,
+                "skip_sounds": skip_sounds,
+                "skip_images": skip_images,
+            })
+            rows = await cursor.fetchall()
+    except HTTPException:
+        raise
+    except Exception as e:
+        print("Error in get_collection_media", e)
+        raise HTTPException(status_code=500, detail="Error fetching media")
+    rows = await run_in_threadpool(media.existing_rows, MEDIA_FOLDER, rows)
+    return StreamingResponse(
+        media.stream_zip(media.media_files(MEDIA_FOLDER, rows), media.media_manifest(rows)),
+        media_type="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="collection-{collection_id}-media.zip"'}
+    )
+
+
+class MediaBatchRequest(BaseModel):
+    sounds: list[int] = Field([], max_length=MEDIA_BATCH_MAX)
+    images: list[int] = Field([], max_length=MEDIA_BATCH_MAX)
+    # "zip": stream the files, "manifest": sizes and sha256 only
+    format: Literal["zip", "manifest"] = "zip"
+
+
+@app.post("/media/batch")
+async def get_media_batch(req: MediaBatchRequest):
+    try:
+        async with db.async_connection() as con:
+            cursor = await con.execute(MEDIA_BATCH_QUERY, (req.sounds, req.images))
+            rows = await cursor.fetchall()
+    except Exception as e:
+        print("Error in get_media_batch", e)
+        raise HTTPException(status_code=500, detail="Error fetching media")
+    if req.format == "manifest":
+        requested = {"sounds": req.sounds, "images": req.images}
+        return await run_in_threadpool(media.batch_manifest, MEDIA_FOLDER, rows, requested)
+    rows = await run_in_threadpool(media.existing_rows, MEDIA_FOLDER, rows)
+    return StreamingResponse(
+        media.stream_zip(media.media_files(MEDIA_FOLDER, rows), media.media_manifest(rows)),
+        media_type="application/zip",
+        headers={"Content-Disposition": 'attachment; filename="media.zip"'}
+    )
+
+
+@app.get("/sounds/download/{sound_id}")
+async def get_sound_download(request: Request, sound_id: int):
+    return await media_download(request, sound_paths, sound_id)
 
 
 @app.get("/images/download/{image_id}")
-def get_image_download(image_id: int):
-    try:
-        con = get_db_connection()
-        cursor = con.cursor()
-        cursor.execute("SELECT file FROM images WHERE id = %s", (image_id,))
-        res = cursor.fetchone()
-        if not res:
-            raise HTTPException(status_code=404, detail="Data not found")
-        path = os.path.join(MEDIA_FOLDER, res[0])
-        if not os.path.exists(path):
-            raise HTTPException(status_code=404, detail="File not found")
-        return FileResponse(path, filename=res[0], media_type='application/octet-stream')
-    finally:
-        con.close()
+async def get_image_download(request: Request, image_id: int):
+    return await media_download(request, image_paths, image_id)
+
+
+async def media_download(request: Request, paths: media.MediaPathCache, media_id: int):
+    try:
+        entry = await paths.lookup(media_id)
+    except Exception as e:
+        print("Error in media_download", paths.table, media_id, e)
+        raise HTTPException(status_code=500, detail="Error fetching media")
+    if not entry:
+        raise HTTPException(status_code=404, detail="Data not found")
+    file, stat = entry
+    if stat is None:
+        raise HTTPException(status_code=404, detail="File not found")
+    return media.file_response(request, MEDIA_FOLDER, file, file, stat)
+
+
+def metrics_key(key: str):
+    """Metrics are not public; they take the same key as the AI routes."""
+    if key != SECRET_KEY:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Invalid key")
+
+
+@app.get("/api/metrics/db", dependencies=[Depends(metrics_key)])
+async def db_pool_metrics():
+    return db.async_pool_metrics()
+
+
+@app.get("/api/metrics/cache", dependencies=[Depends(metrics_key)])
+async def response_cache_metrics():
+    return response_cache.metrics()
+
+
+@app.get("/api/metrics/auth", dependencies=[Depends(metrics_key)])
+async def token_cache_metrics():
+    return local_tokens.metrics()
 
 
 ### AI Chat Endpoint ###
 
+ai_limiter = ConcurrencyLimiter(AI_MAX_CONCURRENCY, AI_MAX_PER_USER, AI_QUEUE_TIMEOUT, AI_MAX_QUEUE)
+ai_replies = ai_cache.AICache(redis_client)
+chat_store = chat_sessions.SessionStore(redis_client)
+job_queue = ai_jobs.JobQueue(redis_client)
+
+
 class ChatRequest(BaseModel):
     message: str
     key: str
     language: str = DEFAULT_LANGUAGE
     history: list = []
+    # skip the reply cache lookup (the fresh reply is still stored)
+    no_cache: bool = False
+
+
+async def ai_user(request: Request) -> Optional[str]:
+    """Who an AI request counts against for AI_MAX_PER_USER: the Firebase uid
+    when the request carries a valid token, else None. Anonymous requests are
+    only held to the global limit; the client address would lump together
+    everyone behind the same NAT or proxy."""
+    auth_header = request.headers.get("Authorization", "")
+    if auth_header.startswith("Bearer "):
+        try:
+            return (await verify_token_with_cache(auth_header.split()[1]))["uid"]
+        except Exception:
+            pass
+    return None
+
+
+async def lookup_reply(req: ChatRequest):
+    """(cache key, cached reply or None); the key is None when replies are not cached."""
+    if not ai_cache.ENABLED or FAKE_API or MODEL.lower() == "chatgpt":
+        return None, None
+    key = ai_cache.cache_key(req.language, gemini.prompt_version(req.language), req.message, req.history)
+    if req.no_cache:
+        ai_replies.bypassed += 1
+        return key, None
+    return key, await ai_replies.get(key)
+
+
+async def store_reply(key, reply: dict):
+    if key and (reply.get("message") or reply.get("cards")):
+        await ai_replies.put(key, reply)
+
+
+async def generate_reply(req: ChatRequest) -> dict:
+    summary, history = await chat_history.bound_or_truncate(req.history, redis_client, gemini.summarize)
+    return await gemini.chat_async(req.message, req.language, history, summary)
+
+
+def limit_response(e: LimitExceeded) -> JSONResponse:
+    return JSONResponse(status_code=status.HTTP_429_TOO_MANY_REQUESTS if e.per_user else status.HTTP_503_SERVICE_UNAVAILABLE,
+                        content={"result": "error", "reason": e.reason},
+                        headers={"Retry-After": str(e.retry_after)})
 
 
 @app.post("/api/ai/chat")
-def chat(req: ChatRequest):
+async def chat(req: ChatRequest, user: Optional[str] = Depends(ai_user)):
     if req.key != SECRET_KEY:
         return JSONResponse(status_code=200, content={"result": "error"})
+    return await answer(req, user)
+
+
+async def answer(req: ChatRequest, user: Optional[str]):
+    """Reply body for a chat request, or an error response."""
     try:
-        if FAKE_API:
-            resp = {"result": "ok", "message": "Fake response from AI"}
-        else:
-            if MODEL.lower() == "chatgpt":
-                # integrate ChatGPT if needed
-                resp = {}
+        key, reply = await lookup_reply(req)
+        if reply:
+            return {**reply, "result": "ok"}
+        async with ai_limiter.slot(user):
+            if FAKE_API:
+                resp = {"result": "ok", "message": "Fake response from AI"}
             else:
-                resp = gemini.chat(req.message, req.language, req.history)
-            resp["result"] = "ok"
-    except Exception:
+                if MODEL.lower() == "chatgpt":
+                    # integrate ChatGPT if needed
+                    resp = {}
+                else:
+                    resp = await asyncio.wait_for(generate_reply(req), AI_TIMEOUT)
+                    await store_reply(key, resp)
+                resp["result"] = "ok"
+    except LimitExceeded as e:
+        return limit_response(e)
+    except Exception as e:
+        print("Error in chat", type(e).__name__, e)
+        return JSONResponse(status_code=200, content={"result": "error"})
+    return resp
+
+
+def sse_event(event: str, data: dict) -> bytes:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n".encode()
+
+
+async def chat_events(req: ChatRequest, user: Optional[str], on_result=None):
+    """SSE events for a chat request; `on_result(reply)` is awaited with the
+    complete reply before the "result" event is sent."""
+    try:
+        key, reply = await lookup_reply(req)
+        if reply:
+            if on_result:
+                await on_result(reply)
+            yield sse_event("text", {"text": reply.get("message", "")})
+            yield sse_event("result", {**reply, "result": "ok"})
+            return
+        async with ai_limiter.slot(user):
+            if FAKE_API:
+                reply = {"message": "Fake response from AI"}
+                if on_result:
+                    await on_result(reply)
+                yield sse_event("text", {"text": reply["message"]})
+                yield sse_event("result", {**reply, "result": "ok"})
+                return
+            deadline = asyncio.get_running_loop().time() + AI_TIMEOUT
+            summary, history = await asyncio.wait_for(
+                chat_history.bound_or_truncate(req.history, redis_client, gemini.summarize), AI_TIMEOUT)
+            events = gemini.chat_stream(req.message, req.language, history, summary)
+            while True:
+                remaining = deadline - asyncio.get_running_loop().time()
+                try:
+                    event, data = await asyncio.wait_for(events.__anext__(), max(remaining, 0))
+                except StopAsyncIteration:
+                    break
+                if event == "text":
+                    yield sse_event("text", {"text": data})
+                else:
+                    await store_reply(key, data)
+                    if on_result:
+                        await on_result(data)
+                    yield sse_event("result", {**data, "result": "ok"})
+    except LimitExceeded as e:
+        yield sse_event("error", {"result": "error", "reason": e.reason})
+    except Exception as e:
+        print("Error in chat_events", type(e).__name__, e)
+        yield sse_event("error", {"result": "error"})
+
+
+@app.post("/api/ai/chat/stream")
+async def chat_stream(req: ChatRequest, user: Optional[str] = Depends(ai_user)):
+    """/api/ai/chat as Server-Sent Events: "text" events with chunks of the
+    message while it is generated, then one "result" event with the body
+    /api/ai/chat would return (cards included), or an "error" event."""
+    if req.key != SECRET_KEY:
+        return JSONResponse(status_code=200, content={"result": "error"})
+    return StreamingResponse(chat_events(req, user), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+class SessionCreateRequest(BaseModel):
+    key: str
+    language: str = DEFAULT_LANGUAGE
+
+
+class SessionMessageRequest(BaseModel):
+    key: str
+    message: str
+    no_cache: bool = False
+
+
+async def session_chat_request(session_id: str, req: SessionMessageRequest) -> ChatRequest:
+    session = await chat_store.load(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Session not found")
+    language, history = session
+    return ChatRequest(message=req.message, key=req.key, language=language, history=history, no_cache=req.no_cache)
+
+
+def session_appender(session_id: str, message: str):
+    async def append(reply: dict):
+        parts = reply.get("original_response_parts") or [{"text": reply.get("message", "")}]
+        await chat_store.append(session_id, message, parts)
+    return append
+
+
+@app.post("/api/ai/sessions")
+async def create_chat_session(req: SessionCreateRequest):
+    """Start a chat whose history is kept on the server (chat_sessions.py)."""
+    if req.key != SECRET_KEY:
+        return JSONResponse(status_code=200, content={"result": "error"})
+    session_id = await chat_store.create(req.language)
+    return {"result": "ok", "session_id": session_id, "expires_in": chat_sessions.SESSION_TTL}
+
+
+@app.get("/api/ai/sessions/{session_id}")
+async def get_chat_session(session_id: str, key: str):
+    if key != SECRET_KEY:
+        return JSONResponse(status_code=200, content={"result": "error"})
+    session = await chat_store.load(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Session not found")
+    language, history = session
+    return {"result": "ok", "session_id": session_id, "language": language, "history": history}
+
+
+@app.post("/api/ai/sessions/{session_id}/messages")
+async def post_session_message(session_id: str, req: SessionMessageRequest, user: Optional[str] = Depends(ai_user)):
+    """/api/ai/chat with the history taken from the session; the message and
+    the reply are added to it."""
+    if req.key != SECRET_KEY:
         return JSONResponse(status_code=200, content={"result": "error"})
+    resp = await answer(await session_chat_request(session_id, req), user)
+    if isinstance(resp, dict):
+        await session_appender(session_id, req.message)(resp)
     return resp
 
 
+@app.post("/api/ai/sessions/{session_id}/messages/stream")
+async def post_session_message_stream(session_id: str, req: SessionMessageRequest, user: Optional[str] = Depends(ai_user)):
+    if req.key != SECRET_KEY:
+        return JSONResponse(status_code=200, content={"result": "error"})
+    chat_req = await session_chat_request(session_id, req)
+    return StreamingResponse(chat_events(chat_req, user, on_result=session_appender(session_id, req.message)),
+                             media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+class CardsRequest(BaseModel):
+    key: str
+    topic: str
+    count: int = Field(20, ge=1, le=deck_generation.MAX_CARDS)
+    language: str = DEFAULT_LANGUAGE
+    level: Optional[str] = None
+    # one chunk per subtopic; planned by the model when empty
+    subtopics: list[str] = Field([], max_length=math.ceil(deck_generation.MAX_CARDS / deck_generation.CARDS_PER_CHUNK))
+
+
+async def card_events(req: CardsRequest, user: Optional[str]):
+    total = failed = 0
+    try:
+        # one share of the user's limit for the deck, a global slot per model call
+        async with ai_limiter.user_slot(user):
+            async for chunk in deck_generation.generate_deck(req.topic, req.count, req.language, req.level,
+                                                             req.subtopics, chunk_timeout=AI_TIMEOUT,
+                                                             limit=ai_limiter.call):
+                if chunk["cards"] is None:
+                    failed += 1
+                    continue
+                total += len(chunk["cards"])
+                yield sse_event("cards", {"subtopic": chunk["subtopic"], "cards": chunk["cards"], "total": total})
+            yield sse_event("result", {"result": "ok", "count": total, "failed_chunks": failed})
+    except LimitExceeded as e:
+        yield sse_event("error", {"result": "error", "reason": e.reason})
+    except asyncio.TimeoutError:
+        yield sse_event("error", {"result": "error", "reason": "timeout", "count": total})
+    except Exception as e:
+        print("Error in card_events", type(e).__name__, e)
+        yield sse_event("error", {"result": "error"})
+
+
+@app.post("/api/ai/cards")
+async def generate_ai_cards(req: CardsRequest, user: Optional[str] = Depends(ai_user)):
+    """Generate a deck of up to deck_generation.MAX_CARDS cards in parallel
+    chunks. Server-Sent Events: "cards" with each chunk's new cards as it
+    completes, then "result" with the final count, or "error"."""
+    if req.key != SECRET_KEY:
+        return JSONResponse(status_code=200, content={"result": "error"})
+    return StreamingResponse(card_events(req, user), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+async def enqueue_job(kind: str, request: dict):
+    try:
+        job_id = await job_queue.enqueue(kind, request)
+    except ai_jobs.QueueFull:
+        return JSONResponse(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            content={"result": "error", "reason": "queue full"}, headers={"Retry-After": "30"})
+    return {"result": "ok", "job_id": job_id, "status": "queued"}
+
+
+@app.post("/api/ai/jobs/chat", status_code=status.HTTP_202_ACCEPTED)
+async def enqueue_chat_job(req: ChatRequest):
+    """Queue a chat request for ai_worker.py; poll /api/ai/jobs/{job_id}."""
+    if req.key != SECRET_KEY:
+        return JSONResponse(status_code=200, content={"result": "error"})
+    return await enqueue_job("chat", {"message": req.message, "language": req.language, "history": req.history})
+
+
+@app.post("/api/ai/jobs/cards", status_code=status.HTTP_202_ACCEPTED)
+async def enqueue_cards_job(req: CardsRequest):
+    """Queue a deck generation (as /api/ai/cards) for ai_worker.py."""
+    if req.key != SECRET_KEY:
+        return JSONResponse(status_code=200, content={"result": "error"})
+    return await enqueue_job("cards", req.model_dump(exclude={"key"}))
+
+
+@app.get("/api/ai/jobs/{job_id}")
+async def get_ai_job(job_id: str, key: str):
+    if key != SECRET_KEY:
+        return JSONResponse(status_code=200, content={"result": "error"})
+    state = await job_queue.get(job_id)
+    if state is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return {"result": "ok", **state}
+
+
+async def job_events(job_id: str):
+    pubsub = redis_client.pubsub()
+    loop = asyncio.get_running_loop()
+    try:
+        await pubsub.subscribe(ai_jobs.events_channel(job_id))
+        # read after subscribing so no change falls in between
+        state = await job_queue.get(job_id)
+        if state and state["status"] not in ai_jobs.FINISHED:
+            yield sse_event("status", state)
+        last_sent = loop.time()
+        while state and state["status"] not in ai_jobs.FINISHED:
+            message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=JOB_EVENTS_KEEPALIVE)
+            if message is None:
+                if loop.time() - last_sent >= JOB_EVENTS_KEEPALIVE:
+                    yield b": keepalive\n\n"
+                    last_sent = loop.time()
+                continue
+            data = json.loads(message["data"])
+            if "cards" in data:
+                yield sse_event("cards", {"cards": data["cards"], "progress": data.get("progress")})
+            if "status" in data:
+                state = await job_queue.get(job_id)
+                if state and state["status"] not in ai_jobs.FINISHED:
+                    yield sse_event("status", state)
+            last_sent = loop.time()
+        if state:
+            yield sse_event(state["status"], {"result": "ok", **state})
+    except Exception as e:
+        print("Error in job_events", type(e).__name__, e)
+        yield sse_event("error", {"result": "error"})
+    finally:
+        await pubsub.aclose()
+
+
+@app.get("/api/ai/jobs/{job_id}/events")
+async def get_ai_job_events(job_id: str, key: str):
+    """Server-Sent Events for a job: "status" on every change, "cards" as a
+    deck's chunks complete, and finally "done" or "failed" with the output."""
+    if key != SECRET_KEY:
+        return JSONResponse(status_code=200, content={"result": "error"})
+    if await job_queue.get(job_id) is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return StreamingResponse(job_events(job_id), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.get("/api/metrics/ai", dependencies=[Depends(metrics_key)])
+async def ai_metrics():
+    return {**ai_limiter.metrics(), "cache": ai_replies.metrics()}
+
+
 # Entry point
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,46 @@
+import json
+import asyncio
+
+# Published by the import tools (see tools/card_import.py) whenever
+# collections or their cards are modified. The payload is
+# {"collections": [ids]}; an empty list means "anything may have changed".
+CHANNEL = "collections:changed"
+RECONNECT_DELAY = 5
+
+_handlers = []
+
+
+def on_change(handler):
+    """Register `async def handler(collection_ids: list)` for change signals."""
+    _handlers.append(handler)
+    return handler
+
+
+async def notify(collection_ids: list):
+    for handler in _handlers:
+        try:
+            await handler(collection_ids)
+        except Exception as e:
+            print("Error in collections change handler", handler.__name__, e)
+
+
+async def listen(redis_client):
+    while True:
+        pubsub = redis_client.pubsub()
+        try:
+            await pubsub.subscribe(CHANNEL)
+            async for message in pubsub.listen():
+                if message["type"] != "message":
+                    continue
+                try:
+                    collection_ids = [int(i) for i in json.loads(message["data"]).get("collections") or []]
+                except (ValueError, TypeError, AttributeError):
+                    collection_ids = []
+                await notify(collection_ids)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print("Collections change listener disconnected", e)
+            await asyncio.sleep(RECONNECT_DELAY)
+        finally:
+            await pubsub.aclose()
@@ -0,0 +1,105 @@
+"""Keeps the history sent to the model within a token budget.
+
+The most recent turns are sent verbatim; older ones are replaced by a summary.
+Summaries are stored in Redis by a hash of the turns they cover, built
+incrementally (h_i = sha256(h_{i-1} + turn_i)), so the next request of the same
+conversation finds the summary of its prefix and only summarizes the turns
+that dropped out since ("rolling"). When history has to be cut, it is cut down
+to half the budget so a new summary is needed only every few turns.
+"""
+import os
+import json
+import hashlib
+
+TOKEN_BUDGET = int(os.getenv("AI_HISTORY_TOKEN_BUDGET", 2000))
+SUMMARY_TTL = int(os.getenv("AI_SUMMARY_TTL", 7 * 86400))
+# rough average for the languages we serve; only used to budget
+CHARS_PER_TOKEN = 4
+TURN_OVERHEAD = 4
+PREFIX = "ai:summary:"
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def turn_text(turn: dict) -> str:
+    parts = turn.get("parts")
+    if isinstance(parts, str):
+        return parts
+    texts = []
+    for part in parts or []:
+        if isinstance(part, str):
+            texts.append(part)
+        elif isinstance(part, dict):
+            texts.append(part.get("text") or json.dumps(part.get("function_call"), sort_keys=True))
+    return "\n".join(texts)
+
+
+def turn_tokens(turn: dict) -> int:
+    return estimate_tokens(turn_text(turn)) + TURN_OVERHEAD
+
+
+def prefix_keys(history: list) -> list:
+    """keys[i] identifies history[:i + 1]."""
+    keys = []
+    digest = b""
+    for turn in history:
+        digest = hashlib.sha256(digest + json.dumps(turn, sort_keys=True).encode()).digest()
+        keys.append(PREFIX + digest.hex())
+    return keys
+
+
+def _first_kept(history: list, budget: int) -> int:
+    """Smallest index such that history[index:] fits the budget and starts
+    with a user turn (role 1), or len(history)."""
+    total = 0
+    start = len(history)
+    for i in range(len(history) - 1, -1, -1):
+        total += turn_tokens(history[i])
+        if total > budget:
+            break
+        start = i
+    while start < len(history) and history[start].get("role") != 1:
+        start += 1
+    return start
+
+
+def truncate(history: list, budget: int = TOKEN_BUDGET) -> list:
+    """The recent turns that fit the budget, without a summary."""
+    return history[_first_kept(history, budget):]
+
+
+async def bound_history(history: list, redis_client, summarize, budget: int = TOKEN_BUDGET):
+    """Return (summary or None, recent turns) within `budget` tokens.
+
+    `summarize(previous_summary, turns)` is an async callable producing the
+    new summary text.
+    """
+    if sum(turn_tokens(turn) for turn in history) <= budget:
+        return None, history
+    needed = _first_kept(history, budget)
+    keys = prefix_keys(history)
+    # longest already summarized prefix
+    cached = await redis_client.mget(keys)
+    done, summary = 0, None
+    for i in range(len(keys) - 1, -1, -1):
+        if cached[i] is not None:
+            done, summary = i + 1, cached[i]
+            break
+    if done >= needed:
+        return summary, history[done:]
+    cut = max(_first_kept(history, budget // 2), needed)
+    summary = await summarize(summary, history[done:cut])
+    await redis_client.setex(keys[cut - 1], SUMMARY_TTL, summary)
+    return summary, history[cut:]
+
+
+async def bound_or_truncate(history: list, redis_client, summarize, budget: int = TOKEN_BUDGET):
+    """bound_history, falling back to truncate() without a summary when the
+    summary cannot be made (model or Redis error)."""
+    try:
+        return await bound_history(history, redis_client, summarize, budget)
+    except Exception as e:
+        print("Error summarizing chat history", type(e).__name__, e)
+        return None, truncate(history, budget)
@@ -0,0 +1,52 @@
+"""Chat sessions kept in Redis, so clients send only the new message.
+
+ai:session:<id>        hash with the session's language and creation time
+ai:session:<id>:turns  list of turns in the history format of /api/ai/chat
+                       ({"role": 1 (user) | 2 (model), "parts": ...})
+
+Both keys expire SESSION_TTL seconds after the last message.
+"""
+import os
+import json
+import time
+import secrets
+
+SESSION_TTL = int(os.getenv("AI_SESSION_TTL", 7 * 86400))
+# older turns are dropped; the model only sees a summary of them anyway
+MAX_TURNS = int(os.getenv("AI_SESSION_MAX_TURNS", 200))
+PREFIX = "ai:session:"
+
+
+class SessionStore:
+    def __init__(self, redis_client):
+        self.redis = redis_client
+
+    async def create(self, language: str) -> str:
+        session_id = secrets.token_urlsafe(16)
+        key = PREFIX + session_id
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hset(key, mapping={"language": language, "created": int(time.time())})
+            pipe.expire(key, SESSION_TTL)
+            await pipe.execute()
+        return session_id
+
+    async def load(self, session_id: str):
+        """(language, history) of a session, or None if it does not exist."""
+        key = PREFIX + session_id
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.hget(key, "language")
+            pipe.lrange(key + ":turns", 0, -1)
+            language, turns = await pipe.execute()
+        if language is None:
+            return None
+        return language, [json.loads(turn) for turn in turns]
+
+    async def append(self, session_id: str, message: str, reply_parts: list):
+        key = PREFIX + session_id
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.rpush(key + ":turns", json.dumps({"role": 1, "parts": message}),
+                       json.dumps({"role": 2, "parts": reply_parts}))
+            pipe.ltrim(key + ":turns", -MAX_TURNS, -1)
+            pipe.expire(key, SESSION_TTL)
+            pipe.expire(key + ":turns", SESSION_TTL)
+            await pipe.execute()
@@ -0,0 +1,2 @@
+# tools/ holds one-off import scripts, test_cards.py among them, not tests
+collect_ignore = ["tools"]
@@ -0,0 +1,285 @@
+import os
+import json
+import time
+import threading
+from datetime import date, datetime
+
+import psycopg2
+from psycopg2 import pool as pg_pool
+from psycopg.adapt import Loader
+from psycopg.conninfo import make_conninfo
+from psycopg.rows import dict_row
+from psycopg_pool import AsyncConnectionPool
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Pool settings (see .sample.env)
+POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 5))
+POOL_MAX_OVERFLOW = int(os.getenv("DB_POOL_MAX_OVERFLOW", 10))
+POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 30))
+POOL_IDLE_TIMEOUT = float(os.getenv("DB_POOL_IDLE_TIMEOUT", 300))
+POOL_PRE_PING_AFTER = float(os.getenv("DB_POOL_PRE_PING_AFTER", 30))
+
+# Public columns of the collections table (without the search columns)
+COLLECTION_COLUMNS = "id, name, description, tags, cardsNumber, createdBy, createdAt"
+
+
+def connect_kwargs() -> dict:
+    return dict(
+        host=os.getenv("DB_HOST"),
+        port=os.getenv("DB_PORT"),
+        dbname=os.getenv("DB_NAME"),
+        user=os.getenv("DB_USER"),
+        password=os.getenv("DB_PASSWORD")
+    )
+
+
+def conninfo() -> str:
+    return make_conninfo(**{key: value for key, value in connect_kwargs().items() if value})
+
+
+def prefixed_columns(alias: str) -> str:
+    """COLLECTION_COLUMNS qualified with a table alias, for joins."""
+    return ", ".join(f"{alias}.{column.strip()}" for column in COLLECTION_COLUMNS.split(","))
+
+
+def json_default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return str(value)
+
+
+def encode_json(value) -> bytes:
+    """Compact JSON encoding of rows, matching FastAPI's datetime format."""
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"), default=json_default).encode()
+
+
+class _RawJsonLoader(Loader):
+    """Leaves json values as the bytes Postgres sent, without parsing them."""
+
+    def load(self, data) -> bytes:
+        return bytes(data)
+
+
+async def fetch_json(con, query: str, params=None) -> bytes:
+    """Run a query returning one json column and return it already encoded."""
+    cursor = con.cursor()
+    cursor.adapters.register_loader("json", _RawJsonLoader)
+    await cursor.execute(query, params)
+    row = await cursor.fetchone()
+    return next(iter(row.values()))
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    """Thread-safe psycopg2 pool, used by the Flask server.
+
+    Keeps up to `size` idle connections and allows `max_overflow` extra
+    connections under load, which are closed as soon as they are returned.
+    Connections idle longer than `idle_timeout` are dropped, and connections
+    idle longer than `pre_ping_after` are checked with `SELECT 1` before use.
+    """
+
+    def __init__(self, size=POOL_SIZE, max_overflow=POOL_MAX_OVERFLOW, timeout=POOL_TIMEOUT,
+                 idle_timeout=POOL_IDLE_TIMEOUT, pre_ping_after=POOL_PRE_PING_AFTER, **kwargs):
+        self.size = size
+        self.max_overflow = max_overflow
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.pre_ping_after = pre_ping_after
+        self._kwargs = kwargs or connect_kwargs()
+        self._pool = pg_pool.ThreadedConnectionPool(size, size + max_overflow, **self._kwargs)
+        self._slots = threading.BoundedSemaphore(size + max_overflow)
+        self._lock = threading.Lock()
+        self._last_used = {}
+        self._checked_out = 0
+        self._waiting = 0
+        self._stats = {"checkouts": 0, "timeouts": 0, "reconnects": 0, "wait_time_total": 0.0, "wait_time_max": 0.0}
+
+    def getconn(self):
+        start = time.monotonic()
+        with self._lock:
+            self._waiting += 1
+        try:
+            acquired = self._slots.acquire(timeout=self.timeout)
+        finally:
+            with self._lock:
+                self._waiting -= 1
+        waited = time.monotonic() - start
+        if not acquired:
+            with self._lock:
+                self._stats["timeouts"] += 1
+            raise PoolTimeout(f"no database connection available after {self.timeout}s")
+        try:
+            con = self._checkout()
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._checked_out += 1
+            self._stats["checkouts"] += 1
+            self._stats["wait_time_total"] += waited
+            self._stats["wait_time_max"] = max(self._stats["wait_time_max"], waited)
+        return con
+
+    def putconn(self, con):
+        if con is None:
+            return
+        try:
+            # the underlying pool rolls back open transactions and closes
+            # connections beyond `size` (overflow)
+            self._pool.putconn(con)
+            with self._lock:
+                if con.closed:
+                    self._last_used.pop(id(con), None)
+                else:
+                    self._last_used[id(con)] = time.monotonic()
+        except Exception:
+            self._discard(con)
+        finally:
+            with self._lock:
+                self._checked_out -= 1
+            self._slots.release()
+
+    def _checkout(self):
+        while True:
+            con = self._pool.getconn()
+            with self._lock:
+                last_used = self._last_used.get(id(con))
+            if last_used is None:
+                return con
+            idle = time.monotonic() - last_used
+            if con.closed or idle > self.idle_timeout:
+                self._discard(con)
+                continue
+            if idle > self.pre_ping_after and not self._ping(con):
+                self._discard(con)
+                continue
+            return con
+
+    def _ping(self, con) -> bool:
+        try:
+            with con.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            con.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _discard(self, con):
+        with self._lock:
+            self._last_used.pop(id(con), None)
+            self._stats["reconnects"] += 1
+        try:
+            self._pool.putconn(con, close=True)
+        except Exception:
+            pass
+
+    def metrics(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            checked_out = self._checked_out
+            waiting = self._waiting
+        checkouts = stats.pop("checkouts")
+        return {
+            "size": self.size,
+            "max_overflow": self.max_overflow,
+            "checked_out": checked_out,
+            "idle": len(self._pool._pool),
+            "overflow": max(0, checked_out + len(self._pool._pool) - self.size),
+            "waiting": waiting,
+            "checkouts": checkouts,
+            "timeouts": stats["timeouts"],
+            "reconnects": stats["reconnects"],
+            "wait_time_avg_ms": round(stats["wait_time_total"] / checkouts * 1000, 3) if checkouts else 0.0,
+            "wait_time_max_ms": round(stats["wait_time_max"] * 1000, 3),
+        }
+
+    def closeall(self):
+        self._pool.closeall()
+        with self._lock:
+            self._last_used.clear()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> ConnectionPool:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool()
+    return _pool
+
+
+def getconn():
+    return get_pool().getconn()
+
+
+def putconn(con):
+    get_pool().putconn(con)
+
+
+def pool_metrics() -> dict:
+    return get_pool().metrics()
+
+
+### Async pool (psycopg 3), used by the FastAPI server ###
+
+_async_pool = None
+
+
+async def open_async_pool() -> AsyncConnectionPool:
+    global _async_pool
+    if _async_pool is None:
+        _async_pool = AsyncConnectionPool(
+            conninfo(),
+            min_size=POOL_SIZE,
+            max_size=POOL_SIZE + POOL_MAX_OVERFLOW,
+            timeout=POOL_TIMEOUT,
+            max_idle=POOL_IDLE_TIMEOUT,
+            check=AsyncConnectionPool.check_connection,
+            kwargs={"row_factory": dict_row},
+            open=False,
+        )
+        await _async_pool.open()
+    return _async_pool
+
+
+async def close_async_pool():
+    global _async_pool
+    if _async_pool is not None:
+        await _async_pool.close()
+        _async_pool = None
+
+
+def async_connection():
+    """`async with db.async_connection() as con:` - checks out a connection
+    from the async pool and returns it (rolled back if needed) on exit."""
+    return _async_pool.connection()
+
+
+def async_pool_metrics() -> dict:
+    stats = _async_pool.get_stats()
+    size = stats.get("pool_size", 0)
+    available = stats.get("pool_available", 0)
+    requests = stats.get("requests_num", 0)
+    wait_ms = stats.get("requests_wait_ms", 0)
+    return {
+        "size": POOL_SIZE,
+        "max_overflow": POOL_MAX_OVERFLOW,
+        "checked_out": size - available,
+        "idle": available,
+        "overflow": max(0, size - POOL_SIZE),
+        "waiting": stats.get("requests_waiting", 0),
+        "checkouts": requests,
+        "timeouts": stats.get("requests_errors", 0),
+        "reconnects": stats.get("connections_lost", 0) + stats.get("returns_bad", 0),
+        "wait_time_avg_ms": round(wait_ms / requests, 3) if requests else 0.0,
+    }
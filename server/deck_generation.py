@@ -0,0 +1,101 @@
+"""Large AI decks generated as parallel chunks.
+
+A request for `count` cards is split into chunks of at most CARDS_PER_CHUNK,
+one per subtopic (given by the client or planned by the model), which run
+PARALLEL_CHUNKS at a time. Cards are merged as chunks complete, dropping
+repeated fronts like tools/card_import.py's insert_data does. A deck stops
+after DECK_TIMEOUT seconds overall.
+"""
+import os
+import math
+import asyncio
+import contextlib
+
+import gemini
+
+CARDS_PER_CHUNK = int(os.getenv("AI_CARDS_PER_CHUNK", 25))
+PARALLEL_CHUNKS = int(os.getenv("AI_CARDS_PARALLEL", 4))
+MAX_CARDS = 500
+DECK_TIMEOUT = float(os.getenv("AI_CARDS_TIMEOUT", 300))
+# chunks ask for a few more cards than their share to make up for duplicates
+OVERSHOOT = 1.1
+
+
+def split_count(count: int, subtopics: list) -> list:
+    """(subtopic, cards) chunks covering `count` cards; a subtopic whose share
+    is over CARDS_PER_CHUNK gets several chunks."""
+    chunks = []
+    for i, subtopic in enumerate(subtopics):
+        share = count // len(subtopics) + (1 if i < count % len(subtopics) else 0)
+        while share > 0:
+            size = min(share, CARDS_PER_CHUNK)
+            chunks.append((subtopic, math.ceil(size * OVERSHOOT)))
+            share -= size
+    return chunks
+
+
+async def plan_chunks(topic: str, count: int, language: str, subtopics: list = None,
+                      limit=contextlib.nullcontext) -> list:
+    if subtopics:
+        return split_count(count, subtopics)
+    n = math.ceil(count / CARDS_PER_CHUNK)
+    if n > 1:
+        try:
+            async with limit():
+                planned = await gemini.plan_subtopics(topic, n, language)
+            if planned:
+                return split_count(count, planned)
+        except Exception as e:
+            print("Error planning subtopics", topic, type(e).__name__, e)
+    return split_count(count, [None])
+
+
+async def generate_deck(topic: str, count: int, language: str, level: str = None,
+                        subtopics: list = None, chunk_timeout: float = 60,
+                        timeout: float = DECK_TIMEOUT, limit=contextlib.nullcontext):
+    """Yield {"subtopic", "cards"} as chunks complete, "cards" holding only
+    fronts not seen before (None if the chunk failed), until `count` cards.
+
+    Every model call runs inside `limit()`, e.g. ConcurrencyLimiter.call, so
+    parallel chunks count against the global limit one by one. Raises
+    asyncio.TimeoutError once `timeout` seconds have passed.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    chunks = await asyncio.wait_for(plan_chunks(topic, count, language, subtopics, limit), timeout)
+    semaphore = asyncio.Semaphore(PARALLEL_CHUNKS)
+
+    async def run(subtopic, size):
+        async with semaphore:
+            try:
+                async with limit():
+                    cards = await asyncio.wait_for(
+                        gemini.generate_card_chunk(topic, size, language, subtopic, level), chunk_timeout)
+                return subtopic, cards
+            except Exception as e:
+                print("Error generating cards", topic, subtopic, type(e).__name__, e)
+                return subtopic, None
+
+    tasks = [asyncio.create_task(run(subtopic, size)) for subtopic, size in chunks]
+    seen = set()
+    try:
+        for done in asyncio.as_completed(tasks, timeout=max(deadline - loop.time(), 0)):
+            subtopic, cards = await done
+            if cards is None:
+                yield {"subtopic": subtopic, "cards": None}
+                continue
+            unique = []
+            for card in cards:
+                front, back = (card.get("front") or "").strip(), (card.get("back") or "").strip()
+                if not front or not back or front in seen:
+                    continue
+                seen.add(front)
+                unique.append({"front": front, "back": back})
+                if len(seen) >= count:
+                    break
+            yield {"subtopic": subtopic, "cards": unique}
+            if len(seen) >= count:
+                break
+    finally:
+        for task in tasks:
+            task.cancel()
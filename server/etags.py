@@ -0,0 +1,22 @@
+from fastapi import Request, status
+from fastapi.responses import Response
+
+# clients may keep the response but must revalidate it with If-None-Match
+REVALIDATE = "no-cache"
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    header = request.headers.get("If-None-Match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag for tag in header.split(","))
+
+
+def etag_headers(etag: str, cache_control: str = REVALIDATE) -> dict:
+    return {"ETag": etag, "Cache-Control": cache_control}
+
+
+def not_modified(etag: str, cache_control: str = REVALIDATE) -> Response:
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=etag_headers(etag, cache_control))
@@ -1,12 +1,18 @@
-from flask import Flask, request, jsonify, send_file
-import psycopg2
+from flask import Flask, Response, request, jsonify, send_from_directory, stream_with_context
+from werkzeug.exceptions import NotFound
+from werkzeug.security import safe_join
 import os
+import mimetypes
 import re
 from dotenv import load_dotenv
+import db
+from db import COLLECTION_COLUMNS, prefixed_columns
+from media_headers import MEDIA_OFFLOAD, offload_headers
 import gemini
+import token_verifier
 from psycopg2.extras import RealDictCursor
 import firebase_admin
-from firebase_admin import credentials, auth
+from firebase_admin import credentials
 import redis
 from functools import wraps
 from datetime import timedelta
@@ -18,9 +24,12 @@ app = Flask(__name__)
 
 DB_NAME = "serverdata.db"
 CARDS_COLLECTION_PREVIEW = 10
+DOWNLOAD_CHUNK_ROWS = 500
 MEDIA_FOLDER = "media/"
+MEDIA_MAX_AGE = 31536000
 
 firebase_app = firebase_admin.initialize_app()
+verify_id_token = token_verifier.verify_function(firebase_app)
 
 redis_client = redis.Redis(host='localhost', port=6379, db=0, decode_responses=True)
 CACHE_TTL = 900
@@ -32,7 +41,7 @@ def verify_firebase_token_with_cache(id_token):
         print("cached", cached)
         return json.loads(cached)
 
-    decoded = auth.verify_id_token(id_token)
+    decoded = verify_id_token(id_token)
     print("decoded", decoded)
     redis_client.setex(f"firebase_token:{id_token}", timedelta(seconds=CACHE_TTL), json.dumps(decoded))
     return decoded
@@ -63,14 +72,15 @@ def verify():
     })
 
 def get_db_connection():
-    conn = psycopg2.connect(
-        host=os.getenv("DB_HOST"),
-        port=os.getenv("DB_PORT"),
-        dbname=os.getenv("DB_NAME"),
-        user=os.getenv("DB_USER"),
-        password=os.getenv("DB_PASSWORD")
-    )
-    return conn
+    # pooled connection, hand it back with db.putconn
+    return db.getconn()
+
+@app.route('/api/metrics/db', methods=['GET'])
+def db_pool_metrics():
+    # same key as /api/ai/chat, like the FastAPI metrics routes
+    if request.args.get("key") != SECRET_KEY:
+        return jsonify({"error": "Invalid key"}), 403
+    return jsonify(db.pool_metrics())
 
 @app.route('/collections/search', methods=['GET'])
 def search_collections():
@@ -86,7 +96,7 @@ def search_collections():
         print("Error in search_collections", e)
         return jsonify({"results":None}), 500
     finally:
-        con.close()
+        db.putconn(con)
     return jsonify({"results":results}), 200
 
 @app.route('/collections/preview/<int:id>', methods=['GET'])
@@ -97,7 +107,7 @@ def get_collection_preview(id):
         
         cursor = con.cursor(cursor_factory=RealDictCursor)
 
-        cursor.execute("SELECT * FROM collections WHERE id = %s", (id,))
+        cursor.execute(f"SELECT {COLLECTION_COLUMNS} FROM collections WHERE id = %s", (id,))
         collection_row = cursor.fetchone()
         if not collection_row:
             return jsonify({"collection":None}), 200
@@ -110,30 +120,72 @@ def get_collection_preview(id):
         print("Error in get_collection_preview", e)
         return jsonify({"collection":None, "cards":None}), 500
     finally:
-        con.close()
+        db.putconn(con)
     return jsonify({"collection":collection, "cards":cards}), 200
 
 @app.route('/collections/download/<int:id>', methods=['GET'])
 def get_collection_download(id):
+    fmt = request.args.get("format", "json")
     try:
         con = get_db_connection()
         cursor = con.cursor(cursor_factory=RealDictCursor)
 
-        cursor.execute("SELECT * FROM collections WHERE id = %s", (id,))
+        cursor.execute(f"SELECT {COLLECTION_COLUMNS} FROM collections WHERE id = %s", (id,))
         collection_row = cursor.fetchone()
         if not collection_row:
             return jsonify({"collection":None}), 200
         
         collection = dict(collection_row)
-        cursor.execute("SELECT * FROM cards WHERE collectionId = %s", (id,))
-        cards = cursor.fetchall()
-        cards = [dict(row) for row in cards]
     except Exception as e:
         print("Error in get_collection_download", e)
         return jsonify({"collection":None, "cards":None}), 500
     finally:
-        con.close()
-    return jsonify({"collection":collection, "cards":cards}), 200
+        db.putconn(con)
+
+    if fmt == "ndjson":
+        return Response(stream_with_context(stream_cards_ndjson(collection)), mimetype="application/x-ndjson")
+    return Response(stream_with_context(stream_cards_json(collection)), mimetype="application/json")
+
+def stream_cards(collection_id):
+    # keyset pages of DOWNLOAD_CHUNK_ROWS cards; the connection goes back to
+    # the pool between pages so slow clients do not hold one
+    last_id = 0
+    while True:
+        con = get_db_connection()
+        try:
+            cursor = con.cursor(cursor_factory=RealDictCursor)
+            cursor.execute("SELECT * FROM cards WHERE collectionId = %s AND id > %s ORDER BY id LIMIT %s",
+                           (collection_id, last_id, DOWNLOAD_CHUNK_ROWS))
+            rows = cursor.fetchall()
+        finally:
+            db.putconn(con)
+        if rows:
+            yield [app.json.dumps(dict(row)) for row in rows]
+        if len(rows) < DOWNLOAD_CHUNK_ROWS:
+            return
+        last_id = rows[-1]["id"]
+
+def stream_cards_json(collection):
+    # same document as before: {"collection": ..., "cards": [...]}
+    yield '{"collection":' + app.json.dumps(collection) + ',"cards":['
+    first = True
+    try:
+        for cards in stream_cards(collection["id"]):
+            yield ("" if first else ",") + ",".join(cards)
+            first = False
+    except Exception as e:
+        print("Error in stream_cards_json", e)
+        raise
+    yield "]}"
+
+def stream_cards_ndjson(collection):
+    yield app.json.dumps({"collection":collection}) + "\n"
+    try:
+        for cards in stream_cards(collection["id"]):
+            yield "\n".join(cards) + "\n"
+    except Exception as e:
+        print("Error in stream_cards_ndjson", e)
+        raise
 
 @app.route('/collections/library', methods=['GET'])
 def get_collection_library():
@@ -143,7 +195,7 @@ def get_collection_library():
 
         # TODO: only fetch some of the collections per group
         # Fetch collections
-        cursor.execute("SELECT * FROM collections")
+        cursor.execute(f"SELECT {COLLECTION_COLUMNS} FROM collections")
         collections = cursor.fetchall()
         collections = [dict(row) for row in collections]
 
@@ -161,9 +213,33 @@ def get_collection_library():
         print("Error in get_collection_library", e)
         return jsonify({"collections":None, "groups":None, "collection_groups":None}), 500
     finally:
-        con.close()
+        db.putconn(con)
     return jsonify({"collections":collections, "groups":groups, "collection_groups":collection_groups}), 200
 
+def send_media(file, download_name=None):
+    # send_from_directory joins the path safely and 404s if it is missing;
+    # conditional responses give the MIME type, ETag/Last-Modified, 304 and
+    # Range (206) support, and the WSGI file_wrapper lets servers such as
+    # gunicorn use sendfile. Media files never change, so let clients keep them.
+    if MEDIA_OFFLOAD:
+        return offload_media(file, download_name)
+    try:
+        response = send_from_directory(MEDIA_FOLDER, file, as_attachment=True,
+                                       download_name=download_name, max_age=MEDIA_MAX_AGE)
+    except NotFound:
+        return jsonify({'error': 'File not found'}), 404
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+def offload_media(file, download_name=None):
+    # nginx or Apache sends the file, with the same headers as the FastAPI server
+    file_path = safe_join(MEDIA_FOLDER, file)
+    if file_path is None or not os.path.isfile(file_path):
+        return jsonify({'error': 'File not found'}), 404
+    return Response(headers=offload_headers(file_path, file, download_name or os.path.basename(file)),
+                    mimetype=mimetypes.guess_type(file_path)[0] or "application/octet-stream")
+
 @app.route('/sounds/download/<int:id>', methods=['GET'])
 def get_sound_download(id):
     try:
@@ -172,18 +248,14 @@ def get_sound_download(id):
         cursor.execute("SELECT file FROM sounds WHERE id = %s", (id,))
         res = cursor.fetchone()
         if res:
-            file_path = MEDIA_FOLDER + res[0]
-            if os.path.exists(file_path):
-                return send_file(file_path, as_attachment=True)
-            else:
-                return jsonify({'error': 'File not found'}), 404
+            return send_media(res[0])
         else:
             return jsonify({'error': 'Data not found'}), 404
     except Exception as e:
         print("Error in get_sound_download", e)
         return jsonify({'error': 'Data not found'}), 404
     finally:
-        con.close()
+        db.putconn(con)
     
 @app.route('/images/download/<int:id>', methods=['GET'])
 def get_image_download(id):
@@ -194,18 +266,14 @@ def get_image_download(id):
         cursor.execute("SELECT file FROM images WHERE id = %s", (id,))
         res = cursor.fetchone()
         if res:
-            file_path = MEDIA_FOLDER + res[0]
-            if os.path.exists(file_path):
-                return send_file(file_path, as_attachment=True, download_name=res[0])
-            else:
-                return jsonify({'error': 'File not found'}), 404
+            return send_media(res[0], download_name=res[0])
         else:
             return jsonify({'error': 'Data not found'}), 404
     except Exception as e:
         print("Error in get_image_download", e)
         return jsonify({'error': 'Data not found'}), 404
     finally:
-        con.close()
+        db.putconn(con)
 
 
 def sanitize_query(query):
@@ -215,7 +283,7 @@ def sanitize_query(query):
 # TODO: find a better alternative
 def find_match(con, query):
     cursor = con.cursor()
-    search_query = """SELECT collections.*
+    search_query = f"""SELECT {prefixed_columns("collections")}
                         FROM collections_fts
                         JOIN collections ON collections_fts.rowid = collections.rowid
                         WHERE collections_fts MATCH %s"""
@@ -228,7 +296,7 @@ def find_fuzzy(con, query):
     cursor = con.cursor(cursor_factory=RealDictCursor)
     words = query.split()
     like_clauses = " OR ".join([f"name ILIKE %s OR description ILIKE %s OR tags ILIKE %s" for _ in words])
-    search_query = f"SELECT * FROM collections WHERE {like_clauses}"
+    search_query = f"SELECT {COLLECTION_COLUMNS} FROM collections WHERE {like_clauses}"
 
     params = [f"%{word}%" for word in words for _ in range(3)]
 
@@ -252,7 +320,7 @@ def search_collections(query):
     results = cursor.fetchall()
 
     # Close the connection  
-    conn.close()
+    db.putconn(conn)
 
     return results
 
@@ -1,11 +1,25 @@
 import google.generativeai as genai
 from dotenv import load_dotenv
+from collections.abc import Mapping, Sequence
 import os
 import json
+import hashlib
+import functools
+import chat_history
 
 load_dotenv() 
 genai.configure(api_key=os.environ["GEMINI_API_KEY"])
 
+GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-1.5-flash")
+# one model (and system prompt) per language
+MAX_CACHED_MODELS = 64
+SUMMARY_INSTRUCTION = """Summarize a conversation between a user and a flashcards assistant in at most 150 words.
+Keep what the user asked for (topics, number and kind of cards, level, language) and what was already generated.
+Write the summary in the conversation's language."""
+SUMMARY_INTRO = "Summary of our earlier conversation:\n"
+# card generation always answers with a generate_cards call
+CARDS_TOOL_CONFIG = {"function_calling_config": {"mode": "any", "allowed_function_names": ["generate_cards"]}}
+
 def get_system_context(lang, topic):
     return f"""Please help a user with a question on a specific topic. Please provide a concise short answer.
 User's topic below in quotes (""):
@@ -40,37 +54,141 @@ def generate_cards(front_sides:list['str'], back_sides:list['str']):
 
 
 
-def chat(prompt, language, history):
-    model = genai.GenerativeModel("gemini-1.5-flash", system_instruction=get_system_context_generic(language))
-    messages = [{'role':'user' if h['role'] == 1 else 'model', 'parts': h['parts']} for h in history]
+def _plain(value):
+    # function call args arrive as proto-plus maps and repeated fields
+    if isinstance(value, Mapping):
+        return {key: _plain(val) for key, val in value.items()}
+    if isinstance(value, Sequence) and not isinstance(value, str):
+        return [_plain(val) for val in value]
+    return value
+
+
+@functools.lru_cache(maxsize=MAX_CACHED_MODELS)
+def get_model(language):
+    """Model with the system prompt and tools for a language, built once."""
+    return genai.GenerativeModel(GEMINI_MODEL, system_instruction=get_system_context_generic(language),
+                                 tools=[generate_cards])
+
+
+@functools.lru_cache(maxsize=MAX_CACHED_MODELS)
+def prompt_version(language):
+    """Changes whenever the model or the system prompt does (cache keys)."""
+    material = GEMINI_MODEL + "\n" + get_system_context_generic(language)
+    return hashlib.sha256(material.encode()).hexdigest()[:16]
+
+
+def warm_up(languages):
+    for language in languages:
+        get_model(language)
+
+
+def _messages(prompt, history, summary=None):
+    messages = []
+    if summary:
+        messages.append({'role':'user', 'parts': [SUMMARY_INTRO + summary]})
+        messages.append({'role':'model', 'parts': ["OK."]})
+    messages += [{'role':'user' if h['role'] == 1 else 'model', 'parts': h['parts']} for h in history]
     messages.append({'role':'user', 'parts': [prompt]})
-    response = model.generate_content(messages, tools=[generate_cards])
-    print("server response:", response)
-    print("server response.result.candidates[0].content:", response.candidates[0])
+    return messages
+
+
+def chat(prompt, language, history):
+    response = get_model(language).generate_content(_messages(prompt, history))
+    return parse_parts(response.parts)
+
+
+async def chat_async(prompt, language, history, summary=None):
+    response = await get_model(language).generate_content_async(_messages(prompt, history, summary))
+    return parse_parts(response.parts)
+
+
+async def chat_stream(prompt, language, history, summary=None):
+    """Yield ("text", chunk) as the model writes, then ("result", ...) with the
+    same fields chat() returns."""
+    response = await get_model(language).generate_content_async(_messages(prompt, history, summary), stream=True)
+    parts = []
+    async for chunk in response:
+        for part in chunk.parts:
+            if not part.function_call and part.text:
+                yield "text", part.text
+            parts.append(part)
+    yield "result", parse_parts(parts)
+
+
+@functools.lru_cache(maxsize=1)
+def get_summary_model():
+    return genai.GenerativeModel(GEMINI_MODEL, system_instruction=SUMMARY_INSTRUCTION)
+
+
+async def summarize(previous, turns):
+    """Fold older turns into the running summary of a conversation."""
+    lines = ["Summary so far:", previous, ""] if previous else []
+    lines.append("New messages:")
+    for turn in turns:
+        lines.append(("User: " if turn['role'] == 1 else "Assistant: ") + chat_history.turn_text(turn))
+    response = await get_summary_model().generate_content_async("\n".join(lines))
+    return response.text.strip()
+
+
+def get_cards_context(lang):
+    return f"""You create flashcards for language and knowledge learning.
+Always return the cards with the generate_cards tool. Front and back sides both should be text only, short, and correct.
+Do not repeat cards. Write the cards for a user whose language is {lang}.
+"""
+
+
+@functools.lru_cache(maxsize=MAX_CACHED_MODELS)
+def get_cards_model(language):
+    return genai.GenerativeModel(GEMINI_MODEL, system_instruction=get_cards_context(language),
+                                 tools=[generate_cards], tool_config=CARDS_TOOL_CONFIG)
+
+
+@functools.lru_cache(maxsize=1)
+def get_json_model():
+    return genai.GenerativeModel(GEMINI_MODEL, generation_config={"response_mime_type": "application/json"})
+
+
+async def generate_card_chunk(topic, count, language, subtopic=None, level=None):
+    """One generate_cards call for `count` cards on a topic (or one of its subtopics)."""
+    prompt = f'Generate {count} flashcards about "{topic}"'
+    if subtopic:
+        prompt += f', only about the part "{subtopic}"'
+    if level:
+        prompt += f", for level {level}"
+    response = await get_cards_model(language).generate_content_async(prompt + ".")
+    return parse_parts(response.parts).get("cards") or []
+
+
+async def plan_subtopics(topic, count, language):
+    """Split a topic into `count` distinct subtopics so parallel chunks do not
+    all produce the same cards."""
+    prompt = (f'Split the flashcard topic "{topic}" into {count} distinct, non-overlapping subtopics '
+              f'written in {language}. Reply with a JSON array of {count} short strings.')
+    response = await get_json_model().generate_content_async(prompt)
+    subtopics = [str(s) for s in json.loads(response.text) if s]
+    return subtopics[:count]
+
+
+def parse_parts(response_parts):
+    """Message text, generated cards, and the parts in a form the client can
+    send back in the history."""
     result_text = ""
-    #result_json = {}
-    
-    for part in response.parts:
-        print(type(part))
+    parts = []
+    cards = None
+    for part in response_parts:
         if fn := part.function_call:
-            args = ", ".join(f"{key}={val}" for key, val in fn.args.items())
-            print(f"function call: {fn.name}({args})")
+            args = _plain(fn.args)
+            parts.append({'function_call': {'name': fn.name, 'args': args}})
             if fn.name == "generate_cards":
-                # Extract arguments from the function call
-                front_sides = fn.args.get("front_sides", [])
-                back_sides = fn.args.get("back_sides", [])
-
-                # Call the generate_cards function with extracted arguments
-                cards = generate_cards(front_sides, back_sides)
-                result_json['cards'] = cards
+                cards = generate_cards(args.get("front_sides", []), args.get("back_sides", []))
         else:
-
             result_text += part.text
-
-    original_response_parts = json.loads(str(response.parts)) # todo: can't use response.parts directly, replace to improve performance,
-    result_json = {"original_response_parts": original_response_parts}
-    result_json['message'] = result_text
-    
-    print("server response text:", result_text)
-    print("result_json", result_json)
+            # streamed text comes in many parts, keep one per run of text
+            if parts and 'text' in parts[-1]:
+                parts[-1]['text'] += part.text
+            else:
+                parts.append({'text': part.text})
+    result_json = {"original_response_parts": parts, "message": result_text}
+    if cards is not None:
+        result_json['cards'] = cards
     return result_json
@@ -0,0 +1,92 @@
+import math
+import asyncio
+from collections import defaultdict
+from contextlib import asynccontextmanager
+
+
+class LimitExceeded(Exception):
+    """The caller already has its share of slots, or waited too long for one."""
+
+    def __init__(self, reason: str, retry_after: int, per_user: bool = False):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+        self.per_user = per_user
+
+
+class ConcurrencyLimiter:
+    """At most `max_concurrency` holders at once and `max_per_user` per user.
+
+    Callers over the global limit queue for up to `queue_timeout` seconds;
+    at most `max_queue` of them wait, the rest are turned away immediately.
+    A `user` of None (anonymous caller) only counts against the global limit.
+    """
+
+    def __init__(self, max_concurrency: int, max_per_user: int, queue_timeout: float, max_queue: int):
+        self.max_concurrency = max_concurrency
+        self.max_per_user = max_per_user
+        self.queue_timeout = queue_timeout
+        self.max_queue = max_queue
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.per_user = defaultdict(int)
+        self.active = 0
+        self.waiting = 0
+        self.rejected = 0
+        self.timed_out = 0
+
+    @asynccontextmanager
+    async def slot(self, user: str = None):
+        """One model call for `user`."""
+        async with self.user_slot(user), self.call():
+            yield
+
+    @asynccontextmanager
+    async def user_slot(self, user: str = None):
+        """Counts against the user's share only, for requests that make several
+        model calls, each in its own call()."""
+        if user is not None:
+            if self.per_user[user] >= self.max_per_user:
+                self.rejected += 1
+                raise LimitExceeded("too many concurrent requests", retry_after=1, per_user=True)
+            self.per_user[user] += 1
+        try:
+            yield
+        finally:
+            if user is not None:
+                self.per_user[user] -= 1
+                if not self.per_user[user]:
+                    del self.per_user[user]
+
+    @asynccontextmanager
+    async def call(self):
+        """One of the `max_concurrency` global slots."""
+        await self._acquire()
+        self.active += 1
+        try:
+            yield
+        finally:
+            self.active -= 1
+            self.semaphore.release()
+
+    async def _acquire(self):
+        if self.semaphore.locked() and self.waiting >= self.max_queue:
+            self.rejected += 1
+            raise LimitExceeded("server busy", retry_after=max(1, math.ceil(self.queue_timeout)))
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self.semaphore.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.timed_out += 1
+            raise LimitExceeded("server busy", retry_after=max(1, math.ceil(self.queue_timeout)))
+        finally:
+            self.waiting -= 1
+
+    def metrics(self) -> dict:
+        return {
+            "max_concurrency": self.max_concurrency,
+            "active": self.active,
+            "waiting": self.waiting,
+            "users": len(self.per_user),
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+        }
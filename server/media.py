@@ -0,0 +1,244 @@
+import io
+import os
+import json
+import time
+import asyncio
+import hashlib
+import zipfile
+import functools
+import mimetypes
+from array import array
+from stat import S_IFREG
+from fastapi import Request
+from fastapi.responses import FileResponse, Response
+
+import db
+from etags import etag_matches, etag_headers, not_modified
+from media_headers import IMMUTABLE, MEDIA_OFFLOAD, offload_headers
+
+READ_CHUNK = 256 * 1024
+
+
+def file_etag(stat) -> str:
+    return f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+
+
+def file_response(request: Request, media_folder: str, file: str, filename: str = None, stat=None):
+    """Response for an immutable media file, or None if it does not exist.
+
+    Sends the real MIME type, a long-lived immutable Cache-Control and an ETag
+    from the file's stat; answers If-None-Match with 304. FileResponse handles
+    Range / If-Range requests (206 partial content) for resumed downloads.
+    With MEDIA_OFFLOAD set, the transfer is handed to the reverse proxy.
+    """
+    path = os.path.join(media_folder, file)
+    if stat is None:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+    media_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+    if MEDIA_OFFLOAD:
+        return offload_response(path, file, media_type, filename)
+    etag = file_etag(stat)
+    if etag_matches(request, etag):
+        return not_modified(etag, IMMUTABLE)
+    return FileResponse(path, filename=filename, media_type=media_type,
+                        headers=etag_headers(etag, IMMUTABLE), stat_result=stat)
+
+
+def offload_response(path: str, file: str, media_type: str, filename: str = None) -> Response:
+    """Empty response handing the transfer to the reverse proxy."""
+    return Response(headers=offload_headers(path, file, filename), media_type=media_type)
+
+
+class MediaPathCache:
+    """id -> (file, size, mtime) for the append-only sounds / images tables.
+
+    Entries live in plain arrays indexed by id. The cache is loaded at startup;
+    ids above the highest known one trigger an incremental reload (at most
+    once per REFRESH_INTERVAL), so new inserts show up without a restart.
+    """
+
+    REFRESH_INTERVAL = 1.0
+
+    def __init__(self, media_folder: str, table: str):
+        self.media_folder = media_folder
+        self.table = table
+        self.files = [None]
+        self.sizes = array("q", [-1])
+        self.mtimes = array("q", [0])
+        self.max_id = 0
+        self.last_refresh = 0.0
+        self._lock = asyncio.Lock()
+
+    def __len__(self):
+        return sum(1 for file in self.files if file is not None)
+
+    def _stat(self, file: str):
+        try:
+            stat = os.stat(os.path.join(self.media_folder, file))
+            return stat.st_size, stat.st_mtime_ns
+        except FileNotFoundError:
+            return -1, 0
+
+    def _stat_rows(self, rows: list) -> list:
+        return [self._stat(row["file"]) for row in rows]
+
+    async def refresh(self):
+        async with self._lock:
+            await self._load_new()
+
+    async def _load_new(self):
+        async with db.async_connection() as con:
+            cursor = await con.execute(
+                f"SELECT id, file FROM {self.table} WHERE id > %s ORDER BY id", (self.max_id,))
+            rows = await cursor.fetchall()
+        stats = await asyncio.to_thread(self._stat_rows, rows)
+        for row, (size, mtime) in zip(rows, stats):
+            missing = row["id"] + 1 - len(self.files)
+            if missing > 0:
+                self.files.extend([None] * missing)
+                self.sizes.extend([-1] * missing)
+                self.mtimes.extend([0] * missing)
+            self.files[row["id"]] = row["file"]
+            self.sizes[row["id"]] = size
+            self.mtimes[row["id"]] = mtime
+            self.max_id = row["id"]
+        self.last_refresh = time.monotonic()
+
+    def _needs_refresh(self, media_id: int) -> bool:
+        return media_id > self.max_id and time.monotonic() - self.last_refresh > self.REFRESH_INTERVAL
+
+    async def lookup(self, media_id: int):
+        """Return (file, stat) for a media id, stat being None if the file is
+        missing on disk, or None if the id does not exist."""
+        if media_id <= 0:
+            return None
+        if self._needs_refresh(media_id):
+            async with self._lock:
+                # requests that waited for the lock use the refresh that held it
+                if self._needs_refresh(media_id):
+                    await self._load_new()
+        if media_id >= len(self.files) or self.files[media_id] is None:
+            return None
+        file = self.files[media_id]
+        if self.sizes[media_id] < 0:
+            # the file may have been copied in after the cache was loaded
+            self.sizes[media_id], self.mtimes[media_id] = self._stat(file)
+            if self.sizes[media_id] < 0:
+                return file, None
+        mtime = self.mtimes[media_id]
+        stat = os.stat_result((S_IFREG | 0o644, 0, 0, 1, 0, 0, self.sizes[media_id],
+                               mtime // 10**9, mtime // 10**9, mtime // 10**9,
+                               mtime / 10**9, mtime / 10**9, mtime / 10**9, mtime, mtime, mtime))
+        return file, stat
+
+
+class _ChunkBuffer(io.RawIOBase):
+    """Write-only, non-seekable sink: zipfile then writes entries with data
+    descriptors and we hand the bytes out as soon as they are produced."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def take(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def stream_zip(files, manifest: dict = None):
+    """Yield a zip archive of `files` ((arcname, path) pairs) chunk by chunk,
+    holding at most READ_CHUNK bytes of file data in memory. Files missing on
+    disk are skipped. `manifest` is written first as manifest.json."""
+    for chunk in _zip_chunks(files, manifest):
+        if chunk:
+            yield chunk
+
+
+def _zip_chunks(files, manifest):
+    buffer = _ChunkBuffer()
+    # media files are already compressed (mp3, png), store them as is
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as archive:
+        if manifest is not None:
+            archive.writestr("manifest.json", json.dumps(manifest))
+            yield buffer.take()
+        for arcname, path in files:
+            try:
+                info = zipfile.ZipInfo.from_file(path, arcname)
+                with open(path, "rb") as src, archive.open(info, "w") as dst:
+                    while chunk := src.read(READ_CHUNK):
+                        dst.write(chunk)
+                        yield buffer.take()
+            except FileNotFoundError:
+                print("stream_zip: missing file", path)
+                continue
+            yield buffer.take()
+    yield buffer.take()
+
+
+def media_files(media_folder: str, rows: list):
+    """(arcname, path) pairs for rows with a "file" column relative to media_folder."""
+    return [(row["file"], os.path.join(media_folder, row["file"])) for row in rows]
+
+
+def existing_rows(media_folder: str, rows: list) -> list:
+    """The rows whose file is present on disk, so manifests list only files
+    that end up in the archive."""
+    return [row for row in rows if os.path.isfile(os.path.join(media_folder, row["file"]))]
+
+
+def media_manifest(rows: list) -> dict:
+    """Map of media ids to archive names, per kind ("sounds"/"images")."""
+    manifest = {"sounds": {}, "images": {}}
+    for row in rows:
+        manifest[row["kind"]][str(row["id"])] = row["file"]
+    return manifest
+
+
+@functools.lru_cache(maxsize=4096)
+def _file_digest(path: str, size: int, mtime_ns: int) -> str:
+    # size and mtime are part of the key so a replaced file is hashed again
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(READ_CHUNK):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_info(media_folder: str, row: dict):
+    """Size and sha256 of a media row's file, or None if it is missing on disk."""
+    path = os.path.join(media_folder, row["file"])
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return {
+        "id": row["id"],
+        "file": row["file"],
+        "size": stat.st_size,
+        "sha256": _file_digest(path, stat.st_size, stat.st_mtime_ns),
+    }
+
+
+def batch_manifest(media_folder: str, rows: list, requested: dict) -> dict:
+    """Per-kind file infos for `rows`, plus the requested ids that were not
+    found in the database or on disk."""
+    manifest = {"sounds": [], "images": [], "missing": {"sounds": [], "images": []}}
+    found = {"sounds": set(), "images": set()}
+    for row in rows:
+        info = file_info(media_folder, row)
+        if info:
+            manifest[row["kind"]].append(info)
+            found[row["kind"]].add(row["id"])
+    for kind, ids in requested.items():
+        manifest["missing"][kind] = sorted(set(ids) - found[kind])
+    return manifest
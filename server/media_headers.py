@@ -0,0 +1,34 @@
+"""Media response headers shared by the FastAPI (media.py) and Flask servers,
+so this module imports neither framework."""
+import os
+from urllib.parse import quote
+
+# "nginx" (X-Accel-Redirect) or "apache" (X-Sendfile): let the reverse proxy
+# send media files, see install.txt. Empty: send them from Python.
+MEDIA_OFFLOAD = os.getenv("MEDIA_OFFLOAD", "")
+# nginx `internal` location that maps to the media folder
+MEDIA_ACCEL_PREFIX = os.getenv("MEDIA_ACCEL_PREFIX", "/protected-media/")
+# media files are named by id and never change
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+
+def content_disposition(filename: str) -> str:
+    # like FileResponse: names that need quoting go in RFC 6266 filename*
+    quoted = quote(filename)
+    if quoted != filename:
+        return f"attachment; filename*=UTF-8''{quoted}"
+    return f'attachment; filename="{filename}"'
+
+
+def offload_headers(path: str, file: str, filename: str = None) -> dict:
+    """Headers of an empty response telling nginx (X-Accel-Redirect) or Apache
+    (X-Sendfile) to send the file itself, including ranges and conditional
+    requests."""
+    headers = {"Cache-Control": IMMUTABLE}
+    if filename:
+        headers["Content-Disposition"] = content_disposition(filename)
+    if MEDIA_OFFLOAD == "nginx":
+        headers["X-Accel-Redirect"] = MEDIA_ACCEL_PREFIX + quote(file)
+    else:
+        headers["X-Sendfile"] = os.path.abspath(path)
+    return headers
@@ -0,0 +1,22 @@
+-- Full-text search for /collections/search.
+-- search_vector is maintained by Postgres (generated column), weighted
+-- name (A) > tags (B) > description (C). search_text backs the trigram
+-- fallback used when the full-text query finds nothing (typos).
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+ALTER TABLE collections ADD COLUMN IF NOT EXISTS search_vector tsvector
+    GENERATED ALWAYS AS (
+        setweight(to_tsvector('simple', coalesce(name, '')), 'A') ||
+        setweight(to_tsvector('simple', coalesce(tags, '')), 'B') ||
+        setweight(to_tsvector('simple', coalesce(description, '')), 'C')
+    ) STORED;
+
+ALTER TABLE collections ADD COLUMN IF NOT EXISTS search_text text
+    GENERATED ALWAYS AS (lower(name || ' ' || coalesce(tags, ''))) STORED;
+
+CREATE INDEX IF NOT EXISTS collections_search_vector_idx
+    ON collections USING GIN (search_vector);
+
+CREATE INDEX IF NOT EXISTS collections_search_text_trgm_idx
+    ON collections USING GIN (search_text gin_trgm_ops);
@@ -0,0 +1,79 @@
+-- Version tracking for conditional GETs (ETag / If-None-Match).
+-- collections.version is bumped whenever the collection row or any of its
+-- cards change; library_state.generation is bumped whenever the library
+-- listing (collections, groups, collection_groups) changes.
+
+ALTER TABLE collections ADD COLUMN IF NOT EXISTS version integer NOT NULL DEFAULT 1;
+
+CREATE TABLE IF NOT EXISTS library_state (
+    id boolean PRIMARY KEY DEFAULT true CHECK (id),
+    generation bigint NOT NULL DEFAULT 1
+);
+INSERT INTO library_state (id) VALUES (true) ON CONFLICT DO NOTHING;
+
+-- collection metadata edits bump the version unless the statement sets it itself
+CREATE OR REPLACE FUNCTION bump_collection_version() RETURNS trigger AS $$
+BEGIN
+    IF NEW.version = OLD.version THEN
+        NEW.version := OLD.version + 1;
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS collections_version ON collections;
+CREATE TRIGGER collections_version BEFORE UPDATE ON collections
+    FOR EACH ROW EXECUTE FUNCTION bump_collection_version();
+
+-- card changes bump every affected collection once per statement
+CREATE OR REPLACE FUNCTION bump_cards_collection_version() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        UPDATE collections SET version = version + 1
+            WHERE id IN (SELECT DISTINCT collectionId FROM new_rows);
+    ELSIF TG_OP = 'DELETE' THEN
+        UPDATE collections SET version = version + 1
+            WHERE id IN (SELECT DISTINCT collectionId FROM old_rows);
+    ELSE
+        UPDATE collections SET version = version + 1
+            WHERE id IN (SELECT collectionId FROM new_rows UNION SELECT collectionId FROM old_rows);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS cards_version_insert ON cards;
+CREATE TRIGGER cards_version_insert AFTER INSERT ON cards
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_cards_collection_version();
+
+DROP TRIGGER IF EXISTS cards_version_update ON cards;
+CREATE TRIGGER cards_version_update AFTER UPDATE ON cards
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_cards_collection_version();
+
+DROP TRIGGER IF EXISTS cards_version_delete ON cards;
+CREATE TRIGGER cards_version_delete AFTER DELETE ON cards
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_cards_collection_version();
+
+-- library listing changes bump the generation once per statement
+CREATE OR REPLACE FUNCTION bump_library_generation() RETURNS trigger AS $$
+BEGIN
+    UPDATE library_state SET generation = generation + 1;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS collections_library_generation ON collections;
+CREATE TRIGGER collections_library_generation
+    AFTER INSERT OR DELETE OR UPDATE OF name, description, tags, cardsNumber, createdBy ON collections
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_library_generation();
+
+DROP TRIGGER IF EXISTS groups_library_generation ON groups;
+CREATE TRIGGER groups_library_generation AFTER INSERT OR UPDATE OR DELETE ON groups
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_library_generation();
+
+DROP TRIGGER IF EXISTS collection_groups_library_generation ON collection_groups;
+CREATE TRIGGER collection_groups_library_generation AFTER INSERT OR UPDATE OR DELETE ON collection_groups
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_library_generation();
@@ -0,0 +1,8 @@
+-- Per-group library pages (/collections/library/top, /collections/library/groups/{id})
+-- walk collection_groups by group in collection id order.
+
+CREATE INDEX IF NOT EXISTS collection_groups_group_collection_idx
+    ON collection_groups (group_id, collection_id);
+
+CREATE INDEX IF NOT EXISTS collection_groups_collection_idx
+    ON collection_groups (collection_id);
@@ -0,0 +1,5 @@
+-- Downloads and snapshots read a collection's cards in id order, in keyset
+-- pages (WHERE collectionId = ? AND id > ? ORDER BY id LIMIT ?).
+
+CREATE INDEX IF NOT EXISTS cards_collection_id_idx
+    ON cards (collectionId, id);
@@ -0,0 +1,157 @@
+"""Redis cache of encoded read responses.
+
+Routes decorated with @cached(tag) store their status, headers and body under
+resp:<path>?<query>, and the key is added to the set resp:tag:<tag>. Evicting
+a tag deletes every response built from it:
+
+    collection:<id>  preview and download of one collection
+    library          library listings
+    search           search results
+
+The import tools evict the affected tags themselves (tools/card_import.py,
+same key layout) before publishing the change signal; the servers evict again
+when they receive it.
+"""
+import os
+import json
+import functools
+
+import redis.asyncio as redis
+from fastapi import Request
+from fastapi.responses import FileResponse, Response, StreamingResponse
+
+from db import encode_json
+from etags import etag_matches, not_modified
+
+TTL = int(os.getenv("RESPONSE_CACHE_TTL", 3600))
+# larger streamed downloads are served from snapshots instead
+MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", 4 * 1024 * 1024))
+ENABLED = os.getenv("RESPONSE_CACHE", "1") == "1"
+PREFIX = "resp:"
+TAG_PREFIX = "resp:tag:"
+# headers recomputed by the response on the way out
+SKIP_HEADERS = {"content-length"}
+
+# bodies are bytes, so this client does not decode responses
+client = redis.Redis(host=os.getenv("REDIS_HOST"), port=int(os.getenv("REDIS_PORT", 6379)), db=0)
+
+hits = 0
+misses = 0
+
+
+def cache_key(request: Request) -> str:
+    query = "&".join(sorted(f"{k}={v}" for k, v in request.query_params.multi_items()))
+    return f"{PREFIX}{request.url.path}?{query}"
+
+
+def collection_tags(collection_ids: list) -> list:
+    """Tags to evict when these collections change; [] means everything."""
+    if not collection_ids:
+        return []
+    return [f"collection:{i}" for i in collection_ids] + ["library", "search"]
+
+
+async def _load(key: str):
+    entry = await client.hgetall(key)
+    if not entry:
+        return None
+    return int(entry[b"status"]), json.loads(entry[b"headers"]), entry[b"body"]
+
+
+async def _store(key: str, tag: str, response: Response, body: bytes):
+    headers = {k: v for k, v in response.headers.items() if k.lower() not in SKIP_HEADERS}
+    try:
+        async with client.pipeline(transaction=False) as pipe:
+            pipe.hset(key, mapping={"status": response.status_code, "headers": json.dumps(headers), "body": body})
+            pipe.expire(key, TTL)
+            pipe.sadd(TAG_PREFIX + tag, key)
+            pipe.expire(TAG_PREFIX + tag, TTL)
+            await pipe.execute()
+    except Exception as e:
+        print("Error storing cached response", key, e)
+
+
+async def _tee(key: str, tag: str, response: StreamingResponse, body_iterator):
+    # stored only once body_iterator is exhausted: an error while streaming or
+    # a client disconnect ends this generator before the body is complete
+    chunks, size = [], 0
+    async for chunk in body_iterator:
+        yield chunk
+        if chunks is not None:
+            size += len(chunk)
+            if size > MAX_BYTES:
+                chunks = None
+            else:
+                chunks.append(chunk)
+    if chunks is not None:
+        await _store(key, tag, response, b"".join(chunks))
+
+
+def cached(tag: str, vary: str = ""):
+    """Cache a route's 200 responses in Redis.
+
+    `tag` is formatted with the route's arguments ("collection:{collection_id}"),
+    and so is `vary`, appended to the key for arguments not in the URL.
+    The route must take `request: Request`; a `response: Response` argument's
+    headers are kept with dict results. File responses are not cached, streamed
+    ones are stored once fully sent if under MAX_BYTES.
+    """
+    def decorator(route):
+        @functools.wraps(route)
+        async def wrapper(*args, **kwargs):
+            global hits, misses
+            if not ENABLED:
+                return await route(*args, **kwargs)
+            request = kwargs["request"]
+            key = cache_key(request) + (("#" + vary.format(**kwargs)) if vary else "")
+            try:
+                entry = await _load(key)
+            except Exception as e:
+                print("Error reading cached response", key, e)
+                entry = None
+            if entry:
+                hits += 1
+                status_code, headers, body = entry
+                etag = headers.get("etag")
+                if etag and etag_matches(request, etag):
+                    return not_modified(etag, headers.get("cache-control"))
+                return Response(body, status_code=status_code, headers=headers)
+            misses += 1
+
+            result = await route(*args, **kwargs)
+            route_tag = tag.format(**kwargs)
+            if isinstance(result, FileResponse):
+                return result
+            if isinstance(result, StreamingResponse):
+                if result.status_code == 200:
+                    result.body_iterator = _tee(key, route_tag, result, result.body_iterator)
+                return result
+            if not isinstance(result, Response):
+                extra = kwargs.get("response")
+                result = Response(encode_json(result), media_type="application/json",
+                                  headers=dict(extra.headers) if extra else None)
+            if result.status_code == 200:
+                await _store(key, route_tag, result, result.body)
+            return result
+        return wrapper
+    return decorator
+
+
+async def evict(tags: list):
+    """Delete the responses built from `tags`; an empty list clears the cache."""
+    if not tags:
+        keys = [key async for key in client.scan_iter(match=PREFIX + "*", count=500)]
+    else:
+        async with client.pipeline(transaction=False) as pipe:
+            for tag in tags:
+                pipe.smembers(TAG_PREFIX + tag)
+            members = await pipe.execute()
+        keys = [TAG_PREFIX + tag for tag in tags] + [key for keys in members for key in keys]
+    if keys:
+        await client.delete(*keys)
+
+
+def metrics() -> dict:
+    total = hits + misses
+    return {"enabled": ENABLED, "hits": hits, "misses": misses,
+            "hit_rate": round(hits / total, 3) if total else None}
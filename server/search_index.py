@@ -0,0 +1,136 @@
+import re
+import math
+import bisect
+import unicodedata
+from collections import defaultdict
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+# Field weights: a term in the name counts as 3 occurrences, in tags as 2
+FIELD_WEIGHTS = {"name": 3.0, "tags": 2.0, "description": 1.0}
+# Prefix matches ("span" -> "spanish") score lower than exact terms
+PREFIX_FACTOR = 0.5
+MAX_PREFIX_EXPANSIONS = 50
+
+
+def sanitize_query(query: str) -> str:
+    # punctuation separates words: "English-to-Spanish" -> "English to Spanish"
+    return re.sub(r"[^\w\s]", " ", query)
+
+
+def fold(text: str) -> str:
+    """Lowercase and strip accents, so "Español" matches "espanol"."""
+    decomposed = unicodedata.normalize("NFKD", text.casefold())
+    return "".join(c for c in decomposed if not unicodedata.combining(c))
+
+
+def tokenize(text: str) -> list:
+    # fold first, so accents stripped by NFKD do not split words
+    return sanitize_query(fold(text or "")).split()
+
+
+class SearchIndex:
+    """In-memory inverted index over collections metadata with BM25 scoring."""
+
+    def __init__(self):
+        self.docs = {}
+        self.postings = defaultdict(dict)
+        self.doc_terms = {}
+        self.doc_len = {}
+        self.total_len = 0.0
+        self._terms = []
+        self._terms_dirty = False
+
+    def __len__(self):
+        return len(self.docs)
+
+    def add(self, row: dict):
+        doc_id = row["id"]
+        self.remove(doc_id)
+        weights = defaultdict(float)
+        for field, weight in FIELD_WEIGHTS.items():
+            for term in tokenize(row.get(field)):
+                weights[term] += weight
+        for term, tf in weights.items():
+            self.postings[term][doc_id] = tf
+        self.docs[doc_id] = row
+        self.doc_terms[doc_id] = list(weights)
+        self.doc_len[doc_id] = sum(weights.values())
+        self.total_len += self.doc_len[doc_id]
+        self._terms_dirty = True
+
+    def remove(self, doc_id: int):
+        if doc_id not in self.docs:
+            return
+        for term in self.doc_terms.pop(doc_id):
+            postings = self.postings[term]
+            postings.pop(doc_id, None)
+            if not postings:
+                del self.postings[term]
+        self.total_len -= self.doc_len.pop(doc_id)
+        del self.docs[doc_id]
+        self._terms_dirty = True
+
+    def _expand(self, token: str) -> list:
+        if self._terms_dirty:
+            self._terms = sorted(self.postings)
+            self._terms_dirty = False
+        expanded = []
+        i = bisect.bisect_left(self._terms, token)
+        while i < len(self._terms) and self._terms[i].startswith(token) and len(expanded) < MAX_PREFIX_EXPANSIONS:
+            term = self._terms[i]
+            expanded.append((term, 1.0 if term == token else PREFIX_FACTOR))
+            i += 1
+        return expanded
+
+    def search(self, query: str, limit: int) -> list:
+        tokens = tokenize(query)
+        if not tokens or not self.docs:
+            return []
+        n = len(self.docs)
+        avg_len = self.total_len / n or 1.0
+        scores = defaultdict(float)
+        for token in tokens:
+            for term, factor in self._expand(token):
+                postings = self.postings[term]
+                idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+                for doc_id, tf in postings.items():
+                    norm = K1 * (1 - B + B * self.doc_len[doc_id] / avg_len)
+                    scores[doc_id] += factor * idf * tf * (K1 + 1) / (tf + norm)
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:limit]
+        return [self.docs[doc_id] for doc_id, _ in ranked]
+
+
+index = SearchIndex()
+ready = False
+
+
+async def load(con, columns: str):
+    """Build a fresh index from the collections table and swap it in."""
+    global index, ready
+    cursor = await con.execute(f"SELECT {columns} FROM collections")
+    fresh = SearchIndex()
+    for row in await cursor.fetchall():
+        fresh.add(row)
+    index = fresh
+    ready = True
+    print("search index loaded:", len(fresh), "collections")
+
+
+async def refresh(con, columns: str, collection_ids: list):
+    """Re-read the given collections; an empty list reloads everything."""
+    if not collection_ids or not ready:
+        await load(con, columns)
+        return
+    cursor = await con.execute(f"SELECT {columns} FROM collections WHERE id = ANY(%s)", (collection_ids,))
+    found = set()
+    for row in await cursor.fetchall():
+        index.add(row)
+        found.add(row["id"])
+    for collection_id in set(collection_ids) - found:
+        index.remove(collection_id)
+
+
+def search(query: str, limit: int) -> list:
+    return index.search(query, limit)
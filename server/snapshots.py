@@ -0,0 +1,169 @@
+"""Precompressed collection snapshots served by /collections/download/{id}.
+
+Each collection is materialized as the download document
+{"collection": ..., "cards": [...]} into SNAPSHOT_FOLDER/<id>/<version>.json.gz
+(and .json.zst when the zstandard package is installed), <version> being the
+collections.version it was built from (migrations/002_versions.sql). The
+server only serves the snapshot of the version currently in Postgres, so any
+write makes it stale whether or not a change signal follows. Snapshots are
+rebuilt when a download finds none for the current version, on the
+collections change signal (see changes.py), or with
+
+    python snapshots.py [collection_id ...]
+"""
+import os
+import sys
+import gzip
+import asyncio
+import tempfile
+import contextlib
+
+import db
+from db import COLLECTION_COLUMNS, encode_json
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+SNAPSHOT_FOLDER = os.getenv("SNAPSHOT_FOLDER", "snapshots/")
+CHUNK_ROWS = 500
+GZIP_LEVEL = 9
+ZSTD_LEVEL = 19
+# extensions by Content-Encoding, in order of preference
+ENCODINGS = {"zstd": ".json.zst", "gzip": ".json.gz"}
+
+
+def collection_folder(collection_id: int) -> str:
+    return os.path.join(SNAPSHOT_FOLDER, str(collection_id))
+
+
+def has_snapshot(collection_id: int, version: int) -> bool:
+    return any(os.path.exists(os.path.join(collection_folder(collection_id), f"{version}{ext}"))
+               for ext in ENCODINGS.values())
+
+
+def snapshot_path(collection_id: int, version: int, accept_encoding: str):
+    """Return (path, encoding) of the best snapshot of `version` the client
+    accepts, or None."""
+    accepted = {part.split(";")[0].strip() for part in accept_encoding.lower().split(",")}
+    for encoding, ext in ENCODINGS.items():
+        path = os.path.join(collection_folder(collection_id), f"{version}{ext}")
+        if encoding in accepted and os.path.exists(path):
+            return path, encoding
+    return None
+
+
+class _SnapshotWriter:
+    """Feeds the encoded document to every compressor."""
+
+    def __init__(self, folder: str):
+        os.makedirs(folder, exist_ok=True)
+        self.folder = folder
+        self.files = {}
+        self.streams = {}
+        for encoding, ext in ENCODINGS.items():
+            if encoding == "zstd" and zstandard is None:
+                continue
+            fd, tmp = tempfile.mkstemp(dir=folder, suffix=ext + ".tmp")
+            raw = os.fdopen(fd, "wb")
+            if encoding == "zstd":
+                stream = zstandard.ZstdCompressor(level=ZSTD_LEVEL).stream_writer(raw)
+            else:
+                stream = gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=GZIP_LEVEL, mtime=0)
+            self.files[encoding] = (tmp, raw)
+            self.streams[encoding] = stream
+
+    def write(self, data: bytes):
+        for stream in self.streams.values():
+            stream.write(data)
+
+    def commit(self, version: int):
+        for encoding, stream in self.streams.items():
+            stream.close()
+            tmp, raw = self.files[encoding]
+            raw.close()
+            os.replace(tmp, os.path.join(self.folder, f"{version}{ENCODINGS[encoding]}"))
+
+    def abort(self):
+        for encoding, stream in self.streams.items():
+            tmp, raw = self.files[encoding]
+            try:
+                stream.close()
+                raw.close()
+            finally:
+                os.remove(tmp)
+
+
+def _prune(folder: str, version):
+    """Remove snapshots other than `version` (None: all of them)."""
+    if not os.path.isdir(folder):
+        return
+    others = {}
+    for entry in os.scandir(folder):
+        if entry.name.endswith(tuple(ENCODINGS.values())) and not entry.name.startswith(f"{version}."):
+            others.setdefault(entry.name.split(".")[0], []).append(entry)
+    # keep the previous version too: a request may have picked it just before the switch
+    by_age = sorted(others, key=lambda old: max(e.stat().st_mtime for e in others[old]), reverse=True)
+    for old in by_age[0 if version is None else 1:]:
+        for entry in others[old]:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(entry.path)
+
+
+async def build(collection_id: int):
+    """Materialize one collection. Returns the collections.version it was
+    built from, or None if the collection no longer exists."""
+    folder = collection_folder(collection_id)
+    async with db.async_connection() as con:
+        # the version and the cards must come from the same snapshot of the data
+        await con.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+        cursor = await con.execute(f"SELECT {COLLECTION_COLUMNS}, version FROM collections WHERE id = %s",
+                                   (collection_id,))
+        collection = await cursor.fetchone()
+        if not collection:
+            await asyncio.to_thread(_prune, folder, None)
+            return None
+        version = collection.pop("version")
+        if has_snapshot(collection_id, version):
+            return version
+        writer = await asyncio.to_thread(_SnapshotWriter, folder)
+        try:
+            writer.write(b'{"collection":' + encode_json(collection) + b',"cards":[')
+            first = True
+            async with con.cursor(name=f"snapshot_{collection_id}") as cards:
+                await cards.execute("SELECT * FROM cards WHERE collectionId = %s ORDER BY id", (collection_id,))
+                while rows := await cards.fetchmany(CHUNK_ROWS):
+                    data = b",".join(encode_json(row) for row in rows)
+                    await asyncio.to_thread(writer.write, data if first else b"," + data)
+                    first = False
+            writer.write(b"]}")
+            await asyncio.to_thread(writer.commit, version)
+        except BaseException:
+            await asyncio.to_thread(writer.abort)
+            raise
+    await asyncio.to_thread(_prune, folder, version)
+    return version
+
+
+async def build_many(collection_ids: list):
+    """Rebuild the given collections; an empty list rebuilds all of them."""
+    if not collection_ids:
+        async with db.async_connection() as con:
+            cursor = await con.execute("SELECT id FROM collections ORDER BY id")
+            collection_ids = [row["id"] for row in await cursor.fetchall()]
+    for collection_id in collection_ids:
+        version = await build(collection_id)
+        print("snapshot", collection_id, version)
+
+
+async def _main(collection_ids: list):
+    await db.open_async_pool()
+    try:
+        await build_many(collection_ids)
+    finally:
+        await db.close_async_pool()
+
+
+if __name__ == "__main__":
+    asyncio.run(_main([int(arg) for arg in sys.argv[1:]]))
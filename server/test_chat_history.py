@@ -0,0 +1,116 @@
+"""bound_history against an in-memory Redis and a fake summarizer.
+
+    python -m pytest test_chat_history.py
+"""
+import asyncio
+
+import pytest
+
+import chat_history
+from chat_history import bound_history, bound_or_truncate, prefix_keys, turn_tokens
+
+USER, MODEL = 1, 0
+
+
+class FakeRedis:
+    """The mget / setex subset of redis.asyncio used by chat_history."""
+
+    def __init__(self):
+        self.data = {}
+        self.ttls = {}
+
+    async def mget(self, keys):
+        return [self.data.get(key) for key in keys]
+
+    async def setex(self, key, ttl, value):
+        self.data[key] = value
+        self.ttls[key] = ttl
+
+
+class FakeSummarizer:
+    def __init__(self):
+        self.calls = []
+
+    async def __call__(self, previous, turns):
+        self.calls.append((previous, turns))
+        return f"summary {len(self.calls)}"
+
+
+def conversation(count, first_role=USER):
+    roles = (first_role, MODEL if first_role == USER else USER)
+    return [{"role": roles[i % 2], "parts": [f"turn number {i:03d}"]} for i in range(count)]
+
+
+# every turn of conversation() has the same size; the budget fits four of them
+BUDGET = 4 * turn_tokens(conversation(1)[0])
+
+
+@pytest.fixture
+def redis_client():
+    return FakeRedis()
+
+
+@pytest.fixture
+def summarize():
+    return FakeSummarizer()
+
+
+def bound(history, redis_client, summarize):
+    return asyncio.run(bound_history(history, redis_client, summarize, BUDGET))
+
+
+def test_under_budget_is_unchanged(redis_client, summarize):
+    history = conversation(4)
+    assert bound(history, redis_client, summarize) == (None, history)
+    assert summarize.calls == []
+    assert redis_client.data == {}
+
+
+def test_first_summary_cuts_to_half_the_budget(redis_client, summarize):
+    history = conversation(10)
+    summary, recent = bound(history, redis_client, summarize)
+    assert summary == "summary 1"
+    assert recent == history[8:]
+    assert summarize.calls == [(None, history[:8])]
+    # stored under the key of the summarized prefix
+    key = prefix_keys(history)[7]
+    assert redis_client.data == {key: "summary 1"}
+    assert redis_client.ttls[key] == chat_history.SUMMARY_TTL
+
+
+def test_later_turn_reuses_the_cached_prefix(redis_client, summarize):
+    history = conversation(12)
+    bound(history[:10], redis_client, summarize)
+    summary, recent = bound(history, redis_client, summarize)
+    assert summary == "summary 1"
+    assert recent == history[8:]
+    assert len(summarize.calls) == 1
+
+
+def test_rolling_summary_covers_only_the_new_turns(redis_client, summarize):
+    history = conversation(14)
+    bound(history[:10], redis_client, summarize)
+    summary, recent = bound(history, redis_client, summarize)
+    assert summary == "summary 2"
+    assert recent == history[12:]
+    assert summarize.calls[1] == ("summary 1", history[8:12])
+
+
+def test_history_starting_with_a_model_turn(redis_client, summarize):
+    history = conversation(10, first_role=MODEL)
+    summary, recent = bound(history, redis_client, summarize)
+    # the recent turns always start with a user turn
+    assert recent == history[9:]
+    assert recent[0]["role"] == USER
+    assert summarize.calls == [(None, history[:9])]
+    assert summary == "summary 1"
+
+
+def test_summary_error_falls_back_to_truncation(redis_client):
+    async def failing(previous, turns):
+        raise RuntimeError("model unavailable")
+
+    history = conversation(10)
+    summary, recent = asyncio.run(bound_or_truncate(history, redis_client, failing, BUDGET))
+    assert summary is None
+    assert recent == history[6:]
@@ -0,0 +1,122 @@
+"""SearchIndex ranking, prefix expansion, accent folding, removal and refresh.
+
+    python -m pytest test_search_index.py
+"""
+import asyncio
+
+import pytest
+
+import search_index
+from search_index import PREFIX_FACTOR, SearchIndex, tokenize
+
+
+def collection(id, name, tags="", description=""):
+    return {"id": id, "name": name, "tags": tags, "description": description}
+
+
+@pytest.fixture
+def index():
+    index = SearchIndex()
+    index.add(collection(1, "English-to-Spanish Flashcards (Beginner)", "language", "Common words"))
+    index.add(collection(2, "Capitals of Europe", "geography", "Spanish and French cities too"))
+    index.add(collection(3, "Español básico", "language", "Vocabulario"))
+    index.add(collection(4, "Spain travel", "spanish", "Phrases for a trip"))
+    return index
+
+
+def ids(results):
+    return [row["id"] for row in results]
+
+
+def test_tokenize_splits_on_punctuation_and_folds_accents():
+    assert tokenize("English-to-Spanish Flashcards (Beginner)") == ["english", "to", "spanish", "flashcards", "beginner"]
+    assert tokenize("Español: básico!") == ["espanol", "basico"]
+    assert tokenize(None) == []
+
+
+def test_ranking_name_over_tags_over_description(index):
+    assert ids(index.search("spanish", 10)) == [1, 4, 2]
+
+
+def test_limit(index):
+    assert ids(index.search("spanish", 2)) == [1, 4]
+
+
+def test_punctuated_query(index):
+    assert ids(index.search("english-to-spanish", 1)) == [1]
+
+
+def test_accent_folding(index):
+    assert ids(index.search("espanol", 10)) == [3]
+    assert ids(index.search("ESPAÑOL", 10)) == [3]
+
+
+def test_prefix_matches_score_below_exact(index):
+    # "spa" matches "spanish" and "spain" as prefixes only
+    assert set(ids(index.search("spa", 10))) == {1, 2, 4}
+    index.add(collection(5, "Spa resorts"))
+    assert ids(index.search("spa", 10))[0] == 5
+    assert 0 < PREFIX_FACTOR < 1
+
+
+def test_expand_weights():
+    index = SearchIndex()
+    index.add(collection(1, "span spanish"))
+    assert index._expand("span") == [("span", 1.0), ("spanish", PREFIX_FACTOR)]
+    assert index._expand("x") == []
+
+
+def test_remove(index):
+    index.remove(4)
+    assert 4 not in ids(index.search("spain", 10))
+    assert index.search("spain", 10) == []
+    assert len(index) == 3
+    # removing twice or an unknown id is a no-op
+    index.remove(4)
+    index.remove(99)
+    assert len(index) == 3
+
+
+def test_re_adding_replaces_terms(index):
+    index.add(collection(2, "Capitals of Asia", "geography", "Tokyo"))
+    assert 2 not in ids(index.search("europe", 10))
+    assert ids(index.search("asia", 10)) == [2]
+
+
+def test_empty_query_and_index():
+    assert SearchIndex().search("spanish", 10) == []
+    index = SearchIndex()
+    index.add(collection(1, "Spanish"))
+    assert index.search("!!", 10) == []
+
+
+class FakeConnection:
+    """Enough of an async psycopg connection for load() / refresh()."""
+
+    def __init__(self, rows):
+        self.rows = {row["id"]: row for row in rows}
+
+    async def execute(self, query, params=None):
+        rows = list(self.rows.values())
+        if params:
+            rows = [row for row in rows if row["id"] in params[0]]
+        return FakeCursor(rows)
+
+
+class FakeCursor:
+    def __init__(self, rows):
+        self.rows = rows
+
+    async def fetchall(self):
+        return self.rows
+
+
+def test_refresh_updates_and_drops_deleted_collections():
+    con = FakeConnection([collection(1, "Spanish verbs"), collection(2, "French verbs")])
+    asyncio.run(search_index.load(con, "*"))
+    assert ids(search_index.search("verbs", 10)) == [1, 2]
+    con.rows[1] = collection(1, "Spanish nouns")
+    del con.rows[2]
+    asyncio.run(search_index.refresh(con, "*", [1, 2]))
+    assert ids(search_index.search("verbs", 10)) == []
+    assert ids(search_index.search("nouns", 10)) == [1]
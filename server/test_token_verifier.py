@@ -0,0 +1,94 @@
+"""TokenVerifier against a local fake issuer: tokens minted with a throwaway
+RSA key and checked through StaticKeys, no network access.
+
+    python -m pytest test_token_verifier.py
+"""
+import time
+import datetime
+
+import pytest
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+from google.auth import crypt, jwt
+from firebase_admin import auth
+
+from token_verifier import ISSUER_PREFIX, StaticKeys, TokenVerifier
+
+PROJECT_ID = "test-project"
+KID = "test-key"
+
+
+def make_issuer():
+    """(private key PEM, certificate PEM) of a self-signed test issuer."""
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "securetoken.test")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (x509.CertificateBuilder().subject_name(name).issuer_name(name)
+            .public_key(key.public_key()).serial_number(x509.random_serial_number())
+            .not_valid_before(now - datetime.timedelta(days=1))
+            .not_valid_after(now + datetime.timedelta(days=1))
+            .sign(key, hashes.SHA256()))
+    private_pem = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                    serialization.NoEncryption())
+    return private_pem, cert.public_bytes(serialization.Encoding.PEM).decode()
+
+
+PRIVATE_PEM, CERT_PEM = make_issuer()
+OTHER_PRIVATE_PEM, _ = make_issuer()
+
+
+def mint(private_pem: bytes = PRIVATE_PEM, kid: str = KID, **overrides) -> str:
+    now = int(time.time())
+    claims = {"iss": ISSUER_PREFIX + PROJECT_ID, "aud": PROJECT_ID, "sub": "user-1",
+              "iat": now, "exp": now + 3600, "auth_time": now, "email": "user@example.com"}
+    claims.update(overrides)
+    claims = {k: v for k, v in claims.items() if v is not None}
+    signer = crypt.RSASigner.from_string(private_pem, key_id=kid)
+    return jwt.encode(signer, claims).decode()
+
+
+@pytest.fixture
+def verifier():
+    return TokenVerifier(PROJECT_ID, StaticKeys({KID: CERT_PEM}))
+
+
+def test_valid_token(verifier):
+    claims = verifier.verify(mint())
+    assert claims["uid"] == "user-1"
+    assert claims["email"] == "user@example.com"
+
+
+def test_expired_token(verifier):
+    now = int(time.time())
+    with pytest.raises(auth.ExpiredIdTokenError):
+        verifier.verify(mint(iat=now - 7200, exp=now - 3600))
+
+
+@pytest.mark.parametrize("overrides", [
+    {"aud": "other-project"},
+    {"iss": ISSUER_PREFIX + "other-project"},
+    {"sub": ""},
+    {"sub": None},
+    {"sub": "x" * 129},
+    {"auth_time": int(time.time()) + 3600},
+])
+def test_invalid_claims(verifier, overrides):
+    with pytest.raises(auth.InvalidIdTokenError):
+        verifier.verify(mint(**overrides))
+
+
+def test_unknown_key(verifier):
+    with pytest.raises(auth.InvalidIdTokenError):
+        verifier.verify(mint(kid="other-key"))
+
+
+def test_wrong_signature(verifier):
+    with pytest.raises(auth.InvalidIdTokenError):
+        verifier.verify(mint(private_pem=OTHER_PRIVATE_PEM))
+
+
+def test_malformed_token(verifier):
+    with pytest.raises(auth.InvalidIdTokenError):
+        verifier.verify("not-a-token")
@@ -0,0 +1,65 @@
+"""In-process LRU of verified Firebase ID tokens, consulted before Redis.
+
+Entries are keyed by a hash of the token, never the token itself. Valid tokens
+are kept until their `exp` claim, invalid ones for NEGATIVE_TTL seconds so a
+client retrying a bad token does not hit the verifier every time.
+"""
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+MAX_ENTRIES = int(os.getenv("TOKEN_CACHE_SIZE", 10000))
+NEGATIVE_TTL = int(os.getenv("TOKEN_NEGATIVE_TTL", 30))
+# upper bound whatever the token says; Firebase ID tokens live one hour
+MAX_TTL = 3600
+
+
+def token_key(id_token: str) -> str:
+    return hashlib.sha256(id_token.encode()).hexdigest()
+
+
+def claims_ttl(claims: dict) -> float:
+    """Seconds until the token expires, capped at MAX_TTL."""
+    return max(0.0, min(claims.get("exp", 0) - time.time(), MAX_TTL))
+
+
+class TokenCache:
+    def __init__(self, max_entries: int = MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        # misses that were not in Redis either and went to the verifier
+        self.verified = 0
+
+    def get(self, key: str):
+        """Return (claims, error) for a cached token, or None."""
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] <= now:
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1], entry[2]
+
+    def put(self, key: str, claims: dict = None, error: str = None, ttl: float = NEGATIVE_TTL):
+        if ttl <= 0:
+            return
+        with self.lock:
+            self.entries[key] = (time.monotonic() + ttl, claims, error)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def metrics(self) -> dict:
+        total = self.hits + self.misses
+        return {"size": len(self.entries), "max_entries": self.max_entries,
+                "hits": self.hits, "misses": self.misses, "verified": self.verified,
+                "hit_rate": round(self.hits / total, 3) if total else None}
@@ -0,0 +1,122 @@
+"""Local verification of Firebase ID tokens.
+
+Google's signing certificates are fetched once and kept for the max-age of
+their Cache-Control header, so verifying a new token is a signature check
+instead of a call through firebase_admin. The key source is pluggable: a
+StaticKeys holding a test issuer's certificates lets the server run against
+locally minted tokens.
+"""
+import os
+import re
+import time
+import functools
+import threading
+
+import requests
+from google.auth import jwt
+from firebase_admin import auth
+
+GOOGLE_CERTS_URL = "https://www.googleapis.com/robot/v1/metadata/x509/securetoken@system.gserviceaccount.com"
+ISSUER_PREFIX = "https://securetoken.google.com/"
+# used when the response has no max-age; Google sends about six hours
+DEFAULT_MAX_AGE = 3600
+# an unknown kid refetches the certificates at most this often
+MIN_REFRESH_INTERVAL = 60
+FETCH_TIMEOUT = 10
+CLOCK_SKEW = int(os.getenv("TOKEN_CLOCK_SKEW", 5))
+# "local": TokenVerifier below, "firebase": firebase_admin's verify_id_token
+TOKEN_VERIFIER = os.getenv("TOKEN_VERIFIER", "local")
+
+
+class GoogleCertificates:
+    """kid -> PEM certificate map from Google, cached per Cache-Control."""
+
+    def __init__(self, url: str = GOOGLE_CERTS_URL):
+        self.url = url
+        self.certs = {}
+        self.expires_at = 0.0
+        self.fetched_at = 0.0
+        self.lock = threading.Lock()
+
+    def keys(self, kid: str = None) -> dict:
+        now = time.monotonic()
+        stale = now >= self.expires_at
+        unknown = kid is not None and kid not in self.certs and now - self.fetched_at > MIN_REFRESH_INTERVAL
+        if stale or unknown:
+            with self.lock:
+                # another thread may have refreshed while we waited
+                if self.fetched_at <= now:
+                    self._fetch()
+        return self.certs
+
+    def _fetch(self):
+        try:
+            response = requests.get(self.url, timeout=FETCH_TIMEOUT)
+            response.raise_for_status()
+            certs = response.json()
+        except (requests.RequestException, ValueError) as e:
+            raise auth.CertificateFetchError(f"Failed to fetch token signing certificates: {e}", cause=e)
+        match = re.search(r"max-age=(\d+)", response.headers.get("Cache-Control", ""))
+        now = time.monotonic()
+        self.certs = certs
+        self.fetched_at = now
+        self.expires_at = now + (int(match.group(1)) if match else DEFAULT_MAX_AGE)
+
+
+class StaticKeys:
+    """Fixed kid -> PEM certificate map, e.g. for a local fake issuer."""
+
+    def __init__(self, certs: dict):
+        self.certs = dict(certs)
+
+    def keys(self, kid: str = None) -> dict:
+        return self.certs
+
+
+class TokenVerifier:
+    """Checks an ID token's signature and claims the way firebase_admin does
+    and returns its claims with "uid" set. Raises auth.InvalidIdTokenError
+    (auth.ExpiredIdTokenError for expired tokens) or auth.CertificateFetchError."""
+
+    def __init__(self, project_id: str, key_source=None):
+        if not project_id:
+            raise ValueError("A Firebase project id is required to verify ID tokens")
+        self.project_id = project_id
+        self.issuer = ISSUER_PREFIX + project_id
+        self.key_source = key_source or GoogleCertificates()
+
+    def verify(self, id_token: str) -> dict:
+        try:
+            header = jwt.decode_header(id_token)
+        except ValueError as e:
+            raise auth.InvalidIdTokenError(f"Malformed ID token: {e}", cause=e)
+        if header.get("alg") != "RS256":
+            raise auth.InvalidIdTokenError(f'ID token has incorrect algorithm "{header.get("alg")}", expected "RS256"')
+        kid = header.get("kid")
+        certs = self.key_source.keys(kid)
+        if kid not in certs:
+            raise auth.InvalidIdTokenError("ID token is signed by an unknown key")
+        try:
+            claims = jwt.decode(id_token, certs=certs, audience=self.project_id,
+                                clock_skew_in_seconds=CLOCK_SKEW)
+        except ValueError as e:
+            if "Token expired" in str(e):
+                raise auth.ExpiredIdTokenError(str(e), cause=e)
+            raise auth.InvalidIdTokenError(str(e), cause=e)
+        if claims.get("iss") != self.issuer:
+            raise auth.InvalidIdTokenError(f'ID token has incorrect "iss" claim "{claims.get("iss")}"')
+        subject = claims.get("sub")
+        if not isinstance(subject, str) or not subject or len(subject) > 128:
+            raise auth.InvalidIdTokenError('ID token has an invalid "sub" claim')
+        if claims.get("auth_time", 0) > time.time() + CLOCK_SKEW:
+            raise auth.InvalidIdTokenError('ID token has an "auth_time" in the future')
+        claims["uid"] = subject
+        return claims
+
+
+def verify_function(firebase_app):
+    """The configured `verify(id_token) -> claims` callable. The auth emulator
+    issues unsigned tokens, so it always goes through firebase_admin."""
+    if TOKEN_VERIFIER == "firebase" or os.getenv("FIREBASE_AUTH_EMULATOR_HOST"):
+        return functools.partial(auth.verify_id_token, app=firebase_app)
+    return TokenVerifier(firebase_app.project_id).verify
@@ -1,4 +1,43 @@
+import os
+import json
 import sqlite3
+from dotenv import load_dotenv
+
+load_dotenv("../.env")
+
+# must match CHANNEL in server/changes.py
+COLLECTIONS_CHANGED_CHANNEL = "collections:changed"
+# must match the key layout in server/response_cache.py
+RESPONSE_CACHE_PREFIX = "resp:"
+RESPONSE_CACHE_TAG_PREFIX = "resp:tag:"
+
+
+def evict_cached_responses(client, collection_ids):
+    """Drop the servers' cached responses for these collections, plus the
+    library and search results; an empty list clears the whole cache."""
+    if not collection_ids:
+        keys = list(client.scan_iter(match=RESPONSE_CACHE_PREFIX + "*", count=500))
+    else:
+        tags = [f"collection:{i}" for i in collection_ids] + ["library", "search"]
+        keys = [RESPONSE_CACHE_TAG_PREFIX + tag for tag in tags]
+        for tag in tags:
+            keys.extend(client.smembers(RESPONSE_CACHE_TAG_PREFIX + tag))
+    if keys:
+        client.delete(*keys)
+
+
+def notify_collections_changed(collection_ids):
+    """Tell running servers that these collections changed (search index, caches)."""
+    if not os.getenv("REDIS_HOST"):
+        print("REDIS_HOST not set, servers were not notified about", collection_ids)
+        return
+    try:
+        import redis
+        client = redis.Redis(host=os.getenv("REDIS_HOST"), port=int(os.getenv("REDIS_PORT", 6379)), db=0)
+        evict_cached_responses(client, list(collection_ids))
+        client.publish(COLLECTIONS_CHANGED_CHANNEL, json.dumps({"collections": list(collection_ids)}))
+    except Exception as e:
+        print("failed to notify servers about", collection_ids, e)
 
 def read_csv(name, skip_errors = False, col_num=2):
     data = []
@@ -54,4 +93,5 @@ def insert_data(data, name, description, tags, reverse=False, insert_media_back=
 
     con.commit()
     con.close()
-    return collection_id
\ No newline at end of file
+    notify_collections_changed([collection_id])
+    return collection_id
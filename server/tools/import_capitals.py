@@ -1,5 +1,6 @@
 import demjson
 import sqlite3
+from card_import import notify_collections_changed
 
 data = demjson.decode_file('capitals.data', encoding="utf-8")
 
@@ -27,6 +28,7 @@ num_cards = len(cards)
 cur.execute("INSERT INTO collections (id, name, description,cardsNumber, tags) values (?, ?, ?, ?, ?);",(collection_id,name, description, num_cards, tags))
 cur.executemany("INSERT INTO cards (collectionId, front, back) VALUES (?, ?, ?)", cards)
 con.commit()
+notify_collections_changed([collection_id])
 
 res = cur.execute("SELECT count(*) from cards where collectionId=?", (collection_id,))
 print("inserted cards:",res.fetchone())
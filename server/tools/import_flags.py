@@ -2,6 +2,7 @@ import base64
 import json
 import re
 import sqlite3
+from card_import import notify_collections_changed
 
 
 CHECK_EXISTING = True
@@ -58,6 +59,7 @@ try:
     cur.execute(query, (collection_id,))
 
     cur.execute("commit")
+    notify_collections_changed([collection_id])
 except Exception as err:
     cur.execute("rollback")
     print("failed", err)